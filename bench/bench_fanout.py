@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Benchmark the --workers fan-out.
+
+Pushes rows through a FramePublisher to 1, 2, 4... worker processes and
+measures how fast they are delivered to a fixed set of WebSocket clients.
+The clients run in their own processes so they do not compete with the
+workers for the GIL.
+
+    python3 bench/bench_fanout.py --workers 1 2 4 --clients 64 --messages 2000
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import multiprocessing
+from time import time, sleep
+from threading import Event, Thread
+from queue import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from racemgr.fanout import FramePublisher, startWorkers, stopWorkers
+
+
+def clientMain(port, connections, messages, timeout, ready, results):
+    import websocket
+
+    def reader(ws, done, missing):
+        # Count distinct rows, a duplicate must not hide a missing one.
+        seen = set()
+        try:
+            while len(seen) < messages:
+                data = json.loads(ws.recv())
+                if data.get('type') == 'row':
+                    seen.add(data['rowIndex'])
+        except websocket.WebSocketTimeoutException:
+            missing.append(sorted(set(range(messages)) - seen))
+        done.append(time())
+
+    sockets = [websocket.create_connection('ws://localhost:%d/' % port, timeout=timeout) for i in range(connections)]
+    ready.put(len(sockets))
+    done, missing = [], []
+    threads = [Thread(target=reader, args=(ws, done, missing)) for ws in sockets]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    results.put((max(done), missing))
+    [ws.close() for ws in sockets]
+
+
+def waitForPort(port, timeout=30):
+    import socket
+    deadline = time() + timeout
+    while time() < deadline:
+        try:
+            socket.create_connection(('localhost', port)).close()
+            return True
+        except OSError:
+            sleep(0.1)
+    return False
+
+
+def run(workers, port, clients, clientProcs, messages, timeout):
+    stopEvent = Event()
+    clientQueue = Queue()
+    socketPath = os.path.join(tempfile.gettempdir(), 'racemgr-bench-%d.sock' % os.getpid())
+    publisher = FramePublisher(stopEvent=stopEvent, clientQueue=clientQueue, socketPath=socketPath)
+    publisher.start()
+    processes = startWorkers(workers, socketPath, port, ['bench'], 0)
+    waitForPort(port)
+
+    clientQueue.put(('bench', 'baseline', 'bench'))
+    clientQueue.put(('bench', 'race_info', json.dumps({'type': 'definition', 'title': 'bench', 'headers': []})))
+
+    ctx = multiprocessing.get_context('spawn')
+    ready, results = ctx.Queue(), ctx.Queue()
+    perProc = clients // clientProcs
+    procs = [ctx.Process(target=clientMain, args=(port, perProc, messages, timeout, ready, results)) for i in range(clientProcs)]
+    [p.start() for p in procs]
+    connected = sum(ready.get() for p in procs)
+
+    row = {'type': 'row', 'rowIndex': 0, 'row': [101, 'LEADER', '12:34', '', 3, 'Lastname,Firstname', 'Open A', '0']}
+    start = time()
+    for i in range(messages):
+        row['rowIndex'] = i
+        clientQueue.put(('bench', 'recorded', json.dumps(row)))
+    finished, missing = 0, []
+    for p in procs:
+        done, lost = results.get()
+        finished = max(finished, done)
+        missing += lost
+    elapsed = finished - start
+
+    [p.join() for p in procs]
+    stopEvent.set()
+    publisher.join()
+    stopWorkers(processes)
+    return connected, elapsed, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark racemgr --workers fan-out.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Worker process counts to try')
+    parser.add_argument('--clients', type=int, default=64, help='WebSocket clients')
+    parser.add_argument('--client-procs', type=int, default=4, help='Processes running the clients')
+    parser.add_argument('--messages', type=int, default=2000, help='Rows sent to every client')
+    parser.add_argument('--port', type=int, default=18100, help='First WebSocket port to use')
+    parser.add_argument('--timeout', type=float, default=10, help='Seconds a client waits for the next message before giving up')
+    parser.add_argument('--verbose', action='store_true', help='Keep the racemgr log on stderr')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        # racemgr logs to stderr (and prints to stdout), the workers inherit both.
+        stdout = os.dup(1)
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        out = os.fdopen(stdout, 'w')
+    else:
+        out = sys.stdout
+
+    print('cores: %d clients: %d messages: %d' % (os.cpu_count(), args.clients, args.messages), file=out, flush=True)
+    print('%8s %10s %10s %14s %8s' % ('workers', 'clients', 'seconds', 'messages/sec', 'scaling'), file=out, flush=True)
+    base = None
+    for i, workers in enumerate(args.workers):
+        connected, elapsed, missing = run(workers, args.port + i, args.clients, args.client_procs, args.messages, args.timeout)
+        rate = connected * args.messages / elapsed
+        base = base or rate
+        print('%8d %10d %10.2f %14.0f %7.2fx' % (workers, connected, elapsed, rate, rate / base), file=out, flush=True)
+        for lost in missing:
+            print('%8s client missing %d rows: %s' % ('', len(lost), lost[:10]), file=out, flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Benchmark the rider search index.
+
+Loads a synthetic field of riders into a RiderIndex and times type-ahead
+queries of increasing length, plus the incremental update of one rider.
+
+    python3 bench/bench_search.py --riders 5000 --repeat 2000
+"""
+
+
+import os
+import sys
+import random
+import string
+import argparse
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from racemgr.search import RiderIndex
+
+
+def makeName(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(4, 9))).capitalize()
+
+
+def makeField(riders, categories, seed=1):
+    rng = random.Random(seed)
+    teams = ['%s %s' % (makeName(rng), rng.choice(['Racing', 'Cycles', 'CX', 'Velo'])) for i in range(riders // 20 + 1)]
+    return {str(bib): {
+        'FirstName': makeName(rng),
+        'LastName': makeName(rng),
+        'Team': rng.choice(teams),
+        'raceCat': 'Cat %d' % (bib % categories),
+    } for bib in range(1, riders + 1)}
+
+
+def timeit(func, repeat):
+    start = perf_counter()
+    for i in range(repeat):
+        func()
+    return (perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark racemgr rider search.')
+    parser.add_argument('--riders', type=int, default=5000, help='Riders in the field')
+    parser.add_argument('--categories', type=int, default=10, help='Categories in the field')
+    parser.add_argument('--repeat', type=int, default=2000, help='Times each query is run')
+    args = parser.parse_args()
+
+    info = makeField(args.riders, args.categories)
+    index = RiderIndex()
+    start = perf_counter()
+    index.load(info)
+    print('riders: %d load: %.1f ms' % (args.riders, (perf_counter() - start) * 1000))
+
+    rider = info[str(args.riders // 2)]
+    queries = [
+        ('bib 1', '1'), ('bib 12', '12'), ('exact bib', str(args.riders // 2)),
+        ('last 1', rider['LastName'][:1]), ('last 3', rider['LastName'][:3]),
+        ('last + first', '%s %s' % (rider['LastName'][:2], rider['FirstName'][:2])),
+        ('team', rider['Team'].split()[0][:3]), ('no match', 'qqqqq'),
+    ]
+    print('%-14s %-12s %8s %10s' % ('query', 'text', 'results', 'ms/query'))
+    for name, q in queries:
+        results = len(index.search(q))
+        print('%-14s %-12s %8d %10.4f' % (name, q, results, timeit(lambda: index.search(q), args.repeat)))
+    print('%-14s %-12s %8s %10.4f' % ('category', rider['raceCat'], '', timeit(lambda: index.search('', category=rider['raceCat']), args.repeat)))
+
+    bib = str(args.riders // 2)
+    names = [dict(rider, LastName=makeName(random.Random(i))) for i in range(args.repeat)]
+    state = iter(names)
+    print('%-14s %-12s %8s %10.4f' % ('update rider', bib, '', timeit(lambda: index.updateRider(bib, next(state)), args.repeat)))
+
+
+if __name__ == '__main__':
+    main()
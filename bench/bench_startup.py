@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+"""Benchmark racemgr startup.
+
+Times, over several runs each:
+
+    import      python -c "import racemgr.racemgr"
+    headless    --replay of a one message recording with --no-http --no-wsserver, to exit
+    ws          --replay with --no-http, until the WebSocket port accepts
+    full        --replay with HTTP and WebSocket, until both ports accept
+
+    python3 bench/bench_startup.py --runs 5
+"""
+
+
+import os
+import sys
+import json
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+from time import perf_counter, sleep
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RUNNER = os.path.join(ROOT, 'racemgr-runner.py')
+
+
+def writeRecording(path):
+    # A baseline for a race with one rider, enough for racemgr to do some work.
+    reference = {'raceName': 'bench', 'versionCount': 0, 'raceIsRunning': True, 'raceIsUnstarted': False,
+                 'raceIsFinished': False, 'timestamp': 0, 'tNow': 0, 'curRaceTime': 60}
+    data = {'cmd': 'baseline', 'reference': reference,
+            'info': {'1': {'FirstName': 'First', 'LastName': 'Last', 'Team': 'Team', 'status': 'Finisher',
+                           'raceTimes': [0, 60], 'interp': [False, False]}},
+            'categoryDetails': {'All': {'startOffset': 0, 'gender': 'Open', 'laps': 3, 'pos': [1], 'iSort': 0},
+                                'Open': {'startOffset': 0, 'gender': 'Open', 'laps': 3, 'pos': [1], 'iSort': 1}}}
+    with open(path, 'w') as f:
+        f.write(json.dumps({'time': 0, 'data': data}) + '\n')
+
+
+def portOpen(port):
+    try:
+        socket.create_connection(('localhost', port), timeout=0.1).close()
+        return True
+    except OSError:
+        return False
+
+
+def timeImport():
+    start = perf_counter()
+    subprocess.run([sys.executable, '-c', 'import racemgr.racemgr'], cwd=ROOT, check=True)
+    return perf_counter() - start
+
+
+def timeRun(args, ports, timeout=30):
+    start = perf_counter()
+    proc = subprocess.Popen([sys.executable, RUNNER] + args, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not ports:
+            proc.wait(timeout=timeout)
+            return perf_counter() - start
+        while not all(portOpen(port) for port in ports):
+            if proc.poll() is not None or perf_counter() - start > timeout:
+                raise RuntimeError('racemgr exited or did not open %s' % (ports,))
+            sleep(0.005)
+        return perf_counter() - start
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark racemgr startup time.')
+    parser.add_argument('--runs', type=int, default=5, help='Runs of each mode')
+    parser.add_argument('--port', type=int, default=18200, help='First port to use')
+    args = parser.parse_args()
+
+    recording = os.path.join(tempfile.mkdtemp(), 'bench.json')
+    writeRecording(recording)
+
+    modes = [
+        ('import', lambda i: timeImport()),
+        ('headless', lambda i: timeRun(['--replay', recording, '--no-http', '--no-wsserver'], [])),
+        ('ws', lambda i: timeRun(['--replay', recording, '--no-http', '--wsserver', str(args.port + 2 * i)], [args.port + 2 * i])),
+        ('full', lambda i: timeRun(['--replay', recording, '--port', str(args.port + 100 + 2 * i), '--wsserver', str(args.port + 101 + 2 * i)],
+                                   [args.port + 100 + 2 * i, args.port + 101 + 2 * i])),
+    ]
+    print('python: %s runs: %d' % (sys.version.split()[0], args.runs))
+    print('%-10s %10s %10s %10s' % ('mode', 'median ms', 'min ms', 'max ms'))
+    for name, func in modes:
+        times = [func(i) * 1000 for i in range(args.runs)]
+        print('%-10s %10.1f %10.1f %10.1f' % (name, median(times), min(times), max(times)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
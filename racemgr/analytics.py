@@ -0,0 +1,204 @@
+from threading import Lock
+
+from .utils import find_last_false
+
+
+#-----------------------------------------------------------------------
+#
+# Lap time and gap analytics.
+#
+# For each rider we keep their passing times, lap times, best lap, rolling
+# average and trend.  For each category we keep the passing times of every
+# rider on every lap, so the time gap to the category leader on the same lap
+# is a lookup.
+#
+# Riders are updated from the same RAM changes as the expected arrivals, the
+# other riders are not looked at.  A new passing only adds one lap to the
+# rider and to one category lap.  An edit to an earlier lap redoes that rider
+# from the edited lap on.
+#
+# The LiveThread updates and the HTTP threads query, so both hold the lock.
+#
+
+def lapTimeStr(seconds):
+    if seconds is None:
+        return ''
+    minutes, seconds = divmod(round(seconds, 1), 60)
+    return '%d:%04.1f' % (minutes, seconds)
+
+
+def behindStr(seconds):
+    if seconds is None:
+        return ''
+    return '+%s' % lapTimeStr(seconds) if seconds >= 0.05 else ''
+
+
+def bibValue(bib):
+    return int(bib) if bib.isdigit() else bib
+
+
+class RiderLaps:
+
+    def __init__(self, bib, category):
+        self.bib = bib
+        self.category = category
+        self.times = []                 # Race time of each passing, times[0] is the start.
+        self.lapTimes = []              # lapTimes[i] is lap i + 1.
+        self.best = None                # (lapTime, lap)
+        self.average = None
+        self.trend = None
+
+    def aggregate(self, rolling):
+        laps = self.lapTimes
+        if not laps:
+            self.best = self.average = self.trend = None
+            return
+        self.best = min((t, lap) for lap, t in enumerate(laps, 1))
+        recent = laps[-rolling:]
+        self.average = sum(recent) / len(recent)
+        # Last lap against the average of the laps before it, negative is getting faster.
+        before = laps[-rolling - 1:-1]
+        self.trend = laps[-1] - sum(before) / len(before) if before else None
+
+
+class RaceAnalytics:
+
+    def __init__(self, rolling=3):
+        self.rolling = rolling          # Laps in the rolling average.
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.riders = {}            # bib -> RiderLaps
+            self.categories = {}        # category -> {lap: {bib: race time}}
+            self.leaders = {}           # (category, lap) -> race time of the leader, cached
+
+    def lapsOf(self, category, lap):
+        return self.categories.setdefault(category, {}).setdefault(lap, {})
+
+    def truncate(self, rider, lap):
+        # Forget the rider's passings from lap on.
+        for n in range(lap, len(rider.times)):
+            laps = self.categories.get(rider.category, {})
+            passings = laps.get(n)
+            if passings is not None:
+                passings.pop(rider.bib, None)
+                if not passings:
+                    del laps[n]
+                self.leaders.pop((rider.category, n), None)
+        del rider.times[lap:]
+        del rider.lapTimes[max(lap - 1, 0):]
+
+    def updateRider(self, bib, data):
+        bib = str(bib)
+        with self.lock:
+            if data is None or data.get('status') != 'Finisher' or 'raceCat' not in data:
+                self.removeLocked(bib)
+                return
+            last = find_last_false(data.get('interp', []))
+            times = data.get('raceTimes', [])[:last + 1]
+            category = data['raceCat']
+
+            rider = self.riders.get(bib)
+            if rider is not None and rider.category != category:
+                self.removeLocked(bib)
+                rider = None
+            if rider is None:
+                rider = self.riders[bib] = RiderLaps(bib, category)
+
+            # Usually the old times are unchanged and there is one more on the end.
+            old = rider.times
+            n = min(len(old), len(times))
+            if old[:n] == times[:n]:
+                same = n
+            else:
+                same = 0
+                while same < n and old[same] == times[same]:
+                    same += 1
+            if same == len(old) == len(times):
+                return
+            self.truncate(rider, same)
+
+            for lap in range(same, len(times)):
+                rider.times.append(times[lap])
+                if lap == 0:
+                    continue
+                rider.lapTimes.append(times[lap] - times[lap - 1])
+                self.lapsOf(category, lap)[bib] = times[lap]
+                leader = self.leaders.get((category, lap))
+                if leader is not None and times[lap] < leader:
+                    self.leaders[(category, lap)] = times[lap]
+            rider.aggregate(self.rolling)
+
+    def removeLocked(self, bib):
+        rider = self.riders.pop(bib, None)
+        if rider is not None:
+            self.truncate(rider, 0)
+
+    def removeRider(self, bib):
+        with self.lock:
+            self.removeLocked(str(bib))
+
+    def leaderTime(self, category, lap):
+        key = (category, lap)
+        leader = self.leaders.get(key)
+        if leader is None:
+            passings = self.categories.get(category, {}).get(lap)
+            if not passings:
+                return None
+            leader = self.leaders[key] = min(passings.values())
+        return leader
+
+    def behind(self, rider, lap):
+        if lap < 1 or lap >= len(rider.times):
+            return None
+        leader = self.leaderTime(rider.category, lap)
+        return rider.times[lap] - leader if leader is not None else None
+
+    def passingColumns(self, bib, lap):
+        """The Lap Time and Behind columns of the recorded row for this passing."""
+        with self.lock:
+            rider = self.riders.get(str(bib))
+            if rider is None or lap < 1 or lap > len(rider.lapTimes):
+                return ['', '']
+            return [lapTimeStr(rider.lapTimes[lap - 1]), behindStr(self.behind(rider, lap))]
+
+    def riderStats(self, rider):
+        lap = len(rider.lapTimes)
+        return {
+            'bib': bibValue(rider.bib),
+            'category': rider.category,
+            'laps': lap,
+            'raceTime': rider.times[-1] if rider.times else None,
+            'lapTimes': list(rider.lapTimes),
+            'lastLap': rider.lapTimes[-1] if rider.lapTimes else None,
+            'bestLap': rider.best[0] if rider.best else None,
+            'bestLapNumber': rider.best[1] if rider.best else None,
+            'average': rider.average,
+            'trend': rider.trend,
+            'behind': self.behind(rider, lap),
+        }
+
+    def categoryStats(self, category):
+        riders = [r for r in self.riders.values() if r.category == category]
+        fastest = min(((r.best, r.bib) for r in riders if r.best), default=None)
+        laps = self.categories.get(category, {})
+        lap = max(laps, default=0)
+        return {
+            'category': category,
+            'riders': len(riders),
+            'laps': lap,
+            'leader': bibValue(min(laps[lap], key=laps[lap].get)) if lap else None,
+            'fastestLap': {'bib': bibValue(fastest[1]), 'lap': fastest[0][1], 'time': fastest[0][0]} if fastest else None,
+        }
+
+    def query(self, bibs=None, category=None):
+        with self.lock:
+            riders = [r for r in self.riders.values()
+                      if (not bibs or r.bib in bibs) and (not category or r.category == category)]
+            riders.sort(key=lambda r: (r.category, -len(r.times), r.times[-1] if r.times else 0))
+            return {
+                'riders': [self.riderStats(r) for r in riders],
+                'categories': [self.categoryStats(c) for c in sorted(set(r.category for r in riders))],
+            }
@@ -0,0 +1,143 @@
+import os
+import sys
+import argparse
+import traceback
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .ingest import MessageDecoder
+from .live import SynchronizedRaceData
+from .snapshot import encodePassings
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Headless batch conversion of recordings.
+#
+# racemgr-batch streams --save recordings through the same
+# SynchronizedRaceData code as a live feed, processMessage() with
+# processBaseline()/processRAM() and the passings engine, but with no
+# threads, servers or replay sleeps.  Each line is decoded once by the
+# MessageDecoder, straight from the recording.
+#
+# The recorded (passings) table of each race in a recording is written when
+# the race ends, on a baseline for a new race or at the end of the file:
+#
+#   <outdir>/<recording>_<raceName>.json|csv
+#
+# With --every N the table is also written after every N messages:
+#
+#   <outdir>/<recording>_<raceName>_v<versionCount>.json|csv
+#
+# Recordings are independent, so with --jobs N they are converted in N
+# processes.
+#
+
+FORMATS = ('json', 'csv', )
+
+
+def safeName(s):
+    return ''.join(c if c.isalnum() else '_' for c in s)
+
+
+def writeTable(snapshot, outdir, stem, formats, version=False):
+    base = '%s_%s' % (stem, safeName(snapshot.raceInfo['raceName'] or 'race'))
+    if version:
+        base += '_v%d' % (snapshot.raceInfo['versionCount'])
+    paths = []
+    for fmt in formats:
+        path = os.path.join(outdir, '%s.%s' % (base, fmt))
+        with open(path, 'w', newline='') as f:
+            for chunk in encodePassings(snapshot, fmt):
+                f.write(chunk)
+        paths.append(path)
+    return paths
+
+
+def processRecording(path, outdir='.', every=0, formats=FORMATS, verbose=False):
+    """Convert one recording, returns a summary dict."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    stderr = sys.stderr
+    if not verbose:
+        # SynchronizedRaceData logs every message to stderr.
+        sys.stderr = open(os.devnull, 'w')
+    start = perf_counter()
+    summary = {'recording': path, 'messages': 0, 'errors': 0, 'races': [], 'files': []}
+    try:
+        rd = SynchronizedRaceData(raceId=stem)
+        decoder = MessageDecoder()
+
+        def final():
+            if rd.recordedCount:
+                summary['races'].append(rd.raceName)
+                summary['files'] += writeTable(rd.snapshot(), outdir, stem, formats)
+
+        with open(path) as fd:
+            for line in fd:
+                if not line.strip():
+                    continue
+                try:
+                    t, message = decoder.decodeRecorded(line)
+                except Exception as e:
+                    print('processRecording: %s: %s' % (path, e), file=stderr)
+                    summary['errors'] += 1
+                    continue
+                if message.get('cmd') == 'baseline' and message['reference']['raceName'] != rd.raceName:
+                    final()
+                rd.processMessage(None, message)
+                summary['messages'] += 1
+                if every and summary['messages'] % every == 0 and rd.recordedCount:
+                    summary['files'] += writeTable(rd.snapshot(), outdir, stem, formats, version=True)
+        final()
+    finally:
+        if not verbose:
+            sys.stderr.close()
+            sys.stderr = stderr
+    summary['seconds'] = perf_counter() - start
+    return summary
+
+
+def processRecordingSafe(*args):
+    # Runs in a worker process, the exception is reported by the parent.
+    try:
+        return processRecording(*args)
+    except Exception as e:
+        return {'recording': args[0], 'failed': '%s\n%s' % (e, traceback.format_exc())}
+
+
+def batchMain():
+    parser = argparse.ArgumentParser(description='Convert racemgr recordings (see --save) into recorded passings tables.')
+    parser.add_argument('recordings', nargs='+', help='Recording files')
+    parser.add_argument('--output-dir', default='.', help='Directory for the output files (default: current directory)')
+    parser.add_argument('--every', type=int, default=0,
+                        help='Also write the table after every N messages, named with the versionCount (default: final tables only)')
+    parser.add_argument('--format', nargs='+', choices=FORMATS, default=list(FORMATS), help='Output formats (default: json csv)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='Recordings converted in parallel (default: CPU count)')
+    parser.add_argument('--verbose', action='store_true', help='Show the racemgr log on stderr')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    jobs = min(args.jobs, len(args.recordings))
+    work = [(path, args.output_dir, args.every, tuple(args.format), args.verbose) for path in args.recordings]
+    start = perf_counter()
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = [future.result() for future in as_completed([executor.submit(processRecordingSafe, *w) for w in work])]
+    else:
+        results = [processRecordingSafe(*w) for w in work]
+
+    failed = 0
+    for r in sorted(results, key=lambda r: r['recording']):
+        if 'failed' in r:
+            failed += 1
+            print('%s: FAILED %s' % (r['recording'], r['failed']), file=sys.stderr)
+            continue
+        print('%s: messages: %d errors: %d races: %s files: %d %.2f s' % (
+            r['recording'], r['messages'], r['errors'], ', '.join(r['races']) or '-', len(r['files']), r['seconds']))
+    log('batchMain: recordings: %d failed: %d jobs: %d %.2f s' % (len(results), failed, jobs, perf_counter() - start))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    batchMain()
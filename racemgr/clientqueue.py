@@ -0,0 +1,180 @@
+import re
+from collections import deque
+from threading import Condition
+from queue import Empty
+
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# The ingest -> dispatch channel.
+#
+# A drop in replacement for the queue.Queue of (raceId, dataType, data)
+# messages between the LiveThreads and Passings (or the FramePublisher).
+#
+#   - baseline and race_info are control messages, they are delivered before
+#     any queued data.  A baseline also discards the queued data of its race,
+#     the data belongs to the race state the baseline replaces.  Unless the
+#     baseline is for a new race (the raceName changed): then the queued
+#     recorded and leaders of the race that is over go ahead of the baseline,
+#     Passings archives them with that race.
+#   - Messages that only matter in their latest version are coalesced while
+#     they wait: race_time and expected per race, leaders per category, and
+#     recorded rows with the same rowIndex.  The newest data takes the place
+#     of the queued message.
+#   - The data messages are bounded.  When maxsize are waiting the oldest
+#     race_time, expected or leaders message is dropped, a later one replaces
+#     it.  Only if there are none is the oldest recorded row dropped, and its
+#     race is marked for a resync (see takeResync()), the dispatcher would
+#     otherwise miss the row for good.  put() never blocks the LiveThread.
+#     Control messages are few and are never dropped.
+#   - maxsize=0 is unbounded, nothing is ever dropped.  The --workers use
+#     that, a worker cannot ask for a resync.
+#
+
+CONTROL = frozenset(['baseline', 'race_info', ])
+LATEST = frozenset(['race_time', 'expected', ])
+DROPPABLE = frozenset(['race_time', 'expected', 'leaders', ])
+
+ROW_INDEX = re.compile(r'"rowIndex":\s*(\d+)')
+CATEGORY = re.compile(r'"category":\s*("(?:[^"\\]|\\.)*")')
+
+
+def coalesceKey(raceId, dataType, data):
+    if dataType in LATEST:
+        return (raceId, dataType)
+    if dataType == 'recorded':
+        m = ROW_INDEX.search(data)
+        if m:
+            return (raceId, dataType, int(m.group(1)))
+    elif dataType == 'leaders':
+        m = CATEGORY.search(data)
+        if m:
+            return (raceId, dataType, m.group(1))
+    return None
+
+
+class ClientQueue:
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.cond = Condition()
+        self.control = deque()
+        self.data = deque()             # [raceId, dataType, data, key], data is None once delivered or discarded
+        self.pending = {}               # coalesce key -> queued entry
+        self.droppable = deque()        # The DROPPABLE entries of data, dropped first when full.
+        self.size = 0                   # Live entries in data.
+        self.resync = set()             # raceIds that lost a recorded row.
+        self.raceNames = {}             # raceId -> raceName of the last baseline.
+        self.stats = {'put': 0, 'delivered': 0, 'coalesced': 0, 'discarded': 0, 'dropped': 0, 'rowsDropped': 0, 'maxDepth': 0, }
+
+    def discard(self, entry):
+        if entry[3] is not None:
+            self.pending.pop(entry[3], None)
+        entry[3] = entry[2] = None
+        self.size -= 1
+
+    def put(self, item, block=True, timeout=None):
+        raceId, dataType, data = item
+        with self.cond:
+            self.stats['put'] += 1
+            if dataType in CONTROL:
+                if dataType == 'baseline':
+                    self.resync.discard(raceId)     # The baseline sends the whole race anyway.
+                    newRace = self.raceNames.get(raceId, data) != data
+                    self.raceNames[raceId] = data
+                    for entry in self.data:
+                        if entry[2] is not None and entry[0] == raceId:
+                            if newRace and entry[1] in ('recorded', 'leaders', ):
+                                self.control.append((entry[0], entry[1], entry[2]))
+                            else:
+                                self.stats['discarded'] += 1
+                            self.discard(entry)
+                self.control.append(item)
+            else:
+                key = coalesceKey(raceId, dataType, data)
+                entry = self.pending.get(key) if key is not None else None
+                if entry is not None:
+                    entry[2] = data
+                    self.stats['coalesced'] += 1
+                else:
+                    if self.maxsize and self.size >= self.maxsize:
+                        self.dropOldest()
+                    entry = [raceId, dataType, data, key]
+                    if key is not None:
+                        self.pending[key] = entry
+                    self.data.append(entry)
+                    if dataType in DROPPABLE:
+                        self.droppable.append(entry)
+                    self.size += 1
+            depth = len(self.control) + self.size
+            if depth > self.stats['maxDepth']:
+                self.stats['maxDepth'] = depth
+            self.cond.notify()
+
+    def dropOldest(self):
+        # Entries stay in data until popped, discard() marks them dead.
+        while self.droppable:
+            entry = self.droppable.popleft()
+            if entry[2] is not None:
+                self.drop(entry)
+                return
+        while self.data:
+            entry = self.data.popleft()
+            if entry[2] is not None:
+                if entry[1] == 'recorded':
+                    self.resync.add(entry[0])
+                    self.stats['rowsDropped'] += 1
+                self.drop(entry)
+                return
+
+    def drop(self, entry):
+        self.discard(entry)
+        self.stats['dropped'] += 1
+        if self.stats['dropped'] % 1000 == 1:
+            log('ClientQueue.dropOldest: queue full, dropped: %d rows: %d' % (self.stats['dropped'], self.stats['rowsDropped']))
+
+    def takeResync(self, raceId):
+        """True once if a recorded row of raceId was dropped, the race must be sent again."""
+        with self.cond:
+            if raceId in self.resync:
+                self.resync.discard(raceId)
+                return True
+            return False
+
+    def pop(self):
+        if self.control:
+            return self.control.popleft()
+        while self.data:
+            entry = self.data.popleft()
+            if entry[2] is None:
+                continue
+            item = (entry[0], entry[1], entry[2])
+            self.discard(entry)
+            while self.droppable and self.droppable[0][2] is None:
+                self.droppable.popleft()
+            return item
+        return None
+
+    def get(self, block=True, timeout=None):
+        with self.cond:
+            item = self.pop()
+            if item is None and block:
+                self.cond.wait_for(lambda: self.control or self.size, timeout=timeout)
+                item = self.pop()
+            if item is None:
+                raise Empty
+            self.stats['delivered'] += 1
+            return item
+
+    def qsize(self):
+        with self.cond:
+            return len(self.control) + self.size
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def status(self):
+        with self.cond:
+            return dict(self.stats, depth=len(self.control) + self.size, maxsize=self.maxsize)
@@ -0,0 +1,121 @@
+import sys
+import random
+import traceback
+from time import time
+
+import websocket
+
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Connection to the CrossMgr announcer websocket.
+#
+# A baseline is the expensive part of (re)connecting, it is the whole race.
+# So after a reconnect we carry on from the versionCount we already have: if
+# the next RAM message follows on, nothing was missed and no baseline is
+# needed.  If it does not, onMessage asks for one as usual.  A quiet feed
+# that sends nothing is still in sync, so there is no timeout on the resume.
+#
+# Failed connects back off exponentially.  The link is checked with pings:
+# if nothing at all, not even a pong, comes back for two ping intervals the
+# link is dead (a ping to a half-open connection is sent without error) and
+# is reconnected whatever the race state.  A race can be quiet for a long
+# time, so no progress with the link alive is not a reason to reconnect.
+#
+# Frames are read with recv_data(control_frame=True) so the pongs are seen.
+#
+
+DATA_OPCODES = (websocket.ABNF.OPCODE_TEXT, websocket.ABNF.OPCODE_BINARY, )
+
+
+class CrossMgrConnection:
+
+    def __init__(self, rd, stopEvent, minBackoff=1, maxBackoff=30, pingInterval=10):
+        self.rd = rd                    # SynchronizedRaceData
+        self.stopEvent = stopEvent
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.pingInterval = pingInterval
+        self.failures = 0               # Consecutive failed connects.
+        self.stats = rd.connectionStats
+
+    def count(self, name):
+        self.stats[name] += 1
+        log('CrossMgrConnection[%s]: %s stats: %s' % (self.rd.raceId, name, self.stats))
+
+    def backoff(self):
+        delay = min(self.maxBackoff, self.minBackoff * 2 ** self.failures)
+        delay *= random.uniform(0.5, 1.0)
+        self.failures += 1
+        log('CrossMgrConnection[%s]: backoff: %.1f seconds' % (self.rd.raceId, delay))
+        self.stopEvent.wait(delay)
+
+    def connect(self):
+        try:
+            log("CrossMgrConnection.connect crossmgr: %s" % (self.rd.wsurl))
+            ws = websocket.create_connection(self.rd.wsurl, timeout=5)
+        except (OSError, websocket.WebSocketException) as e:
+            log("CrossMgrConnection.connect failed: %s" % (e))
+            self.count('connectFailures')
+            self.backoff()
+            return None
+        self.failures = 0
+        self.count('reconnects' if self.stats['connects'] else 'connects')
+        return ws
+
+    def run(self):
+        ws = self.connect()
+        if ws is None:
+            return
+        try:
+            ws.settimeout(1)
+            now = time()
+            resuming = False
+            if self.rd.versionCount >= 0 and self.rd.raceName:
+                # Carry on from where we were rather than ask for the whole race again.
+                log('CrossMgrConnection.run: resuming from versionCount: %s' % (self.rd.versionCount))
+                resuming = True
+                resumeVersion = self.rd.versionCount
+                resumeBaselines = self.stats['baselinesRequested']
+            else:
+                self.rd.requestBaseline(ws, 'CurrentResults')
+            lastPing = lastHeard = now
+            versionCount, baselines = self.rd.versionCount, self.stats['baselinesReceived']
+
+            while not self.stopEvent.is_set():
+                try:
+                    opcode, data = ws.recv_data( control_frame=True )
+                except websocket.WebSocketTimeoutException:
+                    opcode = None
+                now = time()
+                if opcode is not None:
+                    lastHeard = now
+                if opcode in DATA_OPCODES:
+                    self.rd.onMessage( ws, data )
+                elif opcode == websocket.ABNF.OPCODE_CLOSE:
+                    log('CrossMgrConnection.run: closed by CrossMgr')
+                    return
+
+                if self.rd.versionCount != versionCount or self.stats['baselinesReceived'] != baselines:
+                    versionCount, baselines = self.rd.versionCount, self.stats['baselinesReceived']
+                    if resuming:
+                        resuming = False
+                        if self.stats['baselinesRequested'] == resumeBaselines and versionCount > resumeVersion:
+                            self.count('resumes')
+
+                if now - lastHeard > 2 * self.pingInterval:
+                    log('CrossMgrConnection.run: dead link, nothing received for %.0f seconds' % (now - lastHeard))
+                    self.count('deadLinks')
+                    return
+
+                if now - lastPing > self.pingInterval:
+                    ws.ping()
+                    lastPing = now
+        except Exception as e:
+            log("CrossMgrConnection.run exception: %s" % (e))
+            print(traceback.format_exc(), file=sys.stderr)
+            self.backoff()
+        finally:
+            ws.close()
@@ -0,0 +1,112 @@
+import json
+import heapq
+from statistics import median
+
+from .utils import log, hhmmss, find_last_false
+
+
+#-----------------------------------------------------------------------
+#
+# Expected arrivals, "who's coming next".
+#
+# Each rider's next passing is estimated from the median of their most recent
+# lap times.  The estimates are kept in a heap ordered by expected race time.
+# Updating a rider pushes a new entry and bumps the rider's generation, old
+# entries are discarded lazily when they reach the top of the heap, so a RAM
+# update only costs O(log n) per changed rider instead of a rescan.
+#
+
+# Drop a rider from the feed if they are this late (as a fraction of their lap time).
+OVERDUE = 0.5
+
+
+class ExpectedArrivals:
+
+    def __init__(self, window=60, recentLaps=3):
+        self.window = window            # Seconds ahead to report.
+        self.recentLaps = recentLaps    # Lap times used for each estimate.
+        self.reset()
+
+    def reset(self):
+        self.heap = []                  # (eta, bib, generation)
+        self.riders = {}                # bib -> (eta, generation, lapTime, lap, name, team, raceCat)
+        self.generation = 0
+        self.lastFeed = None
+
+    def estimate(self, data, categoryLaps):
+        if data.get('status') != 'Finisher':
+            return None
+        last = find_last_false(data.get('interp', []))
+        raceTimes = data.get('raceTimes', [])[:last + 1]
+        if len(raceTimes) < 2:          # Need at least one completed lap.
+            return None
+        lap = len(raceTimes) - 1
+        if categoryLaps and lap >= categoryLaps:
+            return None                 # Finished.
+        recent = raceTimes[-(self.recentLaps + 1):]
+        lapTime = median(b - a for a, b in zip(recent, recent[1:]))
+        if lapTime <= 0:
+            return None
+        return raceTimes[-1] + lapTime, lapTime, lap + 1
+
+    def updateRider(self, bib, data, categoryLaps=None):
+        bib = str(bib)
+        estimate = self.estimate(data, categoryLaps)
+        if estimate is None:
+            self.riders.pop(bib, None)
+            return
+        eta, lapTime, lap = estimate
+        self.generation += 1
+        self.riders[bib] = (eta, self.generation, lapTime, lap,
+                            '%s,%s' % (data.get('LastName', ''), data.get('FirstName', '')), data.get('Team', ''), data.get('raceCat', ''))
+        heapq.heappush(self.heap, (eta, bib, self.generation))
+
+    def removeRider(self, bib):
+        self.riders.pop(str(bib), None)
+
+    def current(self, entry):
+        eta, bib, generation = entry
+        r = self.riders.get(bib)
+        return r is not None and r[1] == generation
+
+    def upcoming(self, raceTime):
+        """Riders expected between now (less a grace for late riders) and now + window."""
+        found = []
+        while self.heap:
+            entry = self.heap[0]
+            if not self.current(entry):
+                heapq.heappop(self.heap)        # Superseded or removed.
+                continue
+            eta, bib, generation = entry
+            lapTime = self.riders[bib][2]
+            if eta < raceTime - lapTime * OVERDUE:
+                heapq.heappop(self.heap)        # Overdue, wait for their next passing.
+                self.riders.pop(bib, None)
+                continue
+            if eta > raceTime + self.window:
+                break
+            found.append(heapq.heappop(self.heap))
+        for entry in found:
+            heapq.heappush(self.heap, entry)
+        return [(eta, bib) for eta, bib, generation in found]
+
+    def feed(self, raceTime):
+        """Return an 'expected' message if the upcoming riders changed, else None."""
+        upcoming = self.upcoming(raceTime)
+        key = [(bib, round(eta)) for eta, bib in upcoming]
+        if key == self.lastFeed:
+            return None
+        self.lastFeed = key
+        rows = []
+        for eta, bib in upcoming:
+            _, _, lapTime, lap, name, team, raceCat = self.riders[bib]
+            rows.append([int(bib), name, team, raceCat, lap, hhmmss(eta), round(eta - raceTime)])
+        log('ExpectedArrivals.feed: raceTime: %s riders: %d upcoming: %d' % (hhmmss(raceTime), len(self.riders), len(rows)))
+        return json.dumps({
+            "type": "expected",
+            "raceTime": raceTime,
+            "window": self.window,
+            "headers": ('Bib', 'Name', 'Team', 'Wave', 'Lap', 'ETA', 'In', ),
+            "rows": rows,
+            "eta": [eta for eta, bib in upcoming],
+        })
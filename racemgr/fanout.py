@@ -0,0 +1,249 @@
+import os
+import signal
+import socket
+import struct
+import multiprocessing
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from queue import Queue, Empty
+
+from .threadex import ThreadEx
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Multi-process fan-out.
+#
+# With --workers N the process that talks to CrossMgr (the ingest process)
+# does not serve any spectators.  Instead a FramePublisher takes each message
+# off the ClientQueue, encodes it once as a frame and writes it to every worker
+# over a Unix socket.
+#
+# Each worker process runs its own Passings dispatcher and WSServer.  The
+# workers all listen on the same --wsserver port with SO_REUSEPORT so the
+# kernel spreads the spectator connections across them, and each worker only
+# has to send to its share of the clients.
+#
+# A frame is three big endian lengths followed by the UTF-8 raceId, dataType
+# and data of the (raceId, dataType, data) ClientQueue message.
+#
+
+FRAME = struct.Struct('!III')
+
+
+def encodeFrame(raceId, dataType, data):
+    parts = [str(p).encode('utf-8') for p in (raceId, dataType, data)]
+    return FRAME.pack(*[len(p) for p in parts]) + b''.join(parts)
+
+
+def recvExactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def readFrame(sock):
+    header = recvExactly(sock, FRAME.size)
+    if header is None:
+        return None
+    lengths = FRAME.unpack(header)
+    body = recvExactly(sock, sum(lengths))
+    if body is None:
+        return None
+    parts, offset = [], 0
+    for n in lengths:
+        parts.append(body[offset:offset + n].decode('utf-8'))
+        offset += n
+    return tuple(parts)
+
+
+def closeSocket(sock):
+    # Shutdown first, close alone does not wake a thread blocked in accept() or recv().
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class FramePublisher(ThreadEx):
+    """Ingest side, send every ClientQueue message to all the worker processes."""
+
+    def __init__(self, stopEvent=None, clientQueue=None, socketPath=None):
+        log("FramePublisher.__init__ socketPath: %s" % (socketPath))
+        super(FramePublisher, self).__init__(stopEvent=stopEvent, name='FramePublisher')
+        self.clientQueue = clientQueue
+        self.socketPath = socketPath
+        self.lock = Lock()
+        self.workers = []
+
+        # Frames a worker that connects late needs to catch up, per race.
+        self.frames = OrderedDict()     # raceId -> frames since the last baseline
+        self.latest = OrderedDict()     # (raceId, dataType) -> newest race_time / expected frame
+        self.published = 0
+
+        if os.path.exists(socketPath):
+            os.unlink(socketPath)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(socketPath)
+        self.listener.listen(16)
+        self.acceptor = Thread(target=self.accept, name='FramePublisher.accept', daemon=True)
+
+    def start(self):
+        self.acceptor.start()
+        super(FramePublisher, self).start()
+
+    def accept(self):
+        while not self.stopEvent.is_set():
+            try:
+                conn, addr = self.listener.accept()
+            except OSError:
+                return
+            with self.lock:
+                # Holding the lock keeps the catch-up frames and the live frames in order.
+                try:
+                    for raceId, frames in self.frames.items():
+                        for frame in frames:
+                            conn.sendall(frame)
+                    for frame in self.latest.values():
+                        conn.sendall(frame)
+                except OSError as e:
+                    log("FramePublisher.accept: catch-up failed: %s" % (e))
+                    conn.close()
+                    continue
+                self.workers.append(conn)
+            log("FramePublisher.accept: worker connected, workers: %d" % (len(self.workers)))
+
+    def record(self, raceId, dataType, frame):
+        if dataType == 'baseline':
+            self.frames[raceId] = [frame]
+            for key in [key for key in self.latest if key[0] == raceId]:
+                del self.latest[key]
+        elif dataType in ['race_time', 'expected', ]:
+            self.latest[(raceId, dataType)] = frame
+        else:
+            self.frames.setdefault(raceId, []).append(frame)
+
+    def work(self):
+        try:
+            raceId, dataType, data = self.clientQueue.get(timeout=2)
+        except Empty:
+            return
+        frame = encodeFrame(raceId, dataType, data)
+        with self.lock:
+            self.record(raceId, dataType, frame)
+            for conn in list(self.workers):
+                try:
+                    conn.sendall(frame)
+                except OSError as e:
+                    log("FramePublisher.work: dropping worker: %s" % (e))
+                    self.workers.remove(conn)
+                    conn.close()
+        self.published += 1
+
+    def stop(self):
+        log("FramePublisher.stop")
+        closeSocket(self.listener)
+        with self.lock:
+            for conn in self.workers:
+                closeSocket(conn)
+            self.workers = []
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+
+    # Closing the sockets is what tells the workers to exit.
+    def finalize(self):
+        self.stop()
+
+
+class FrameReceiver(ThreadEx):
+    """Worker side, read frames from the ingest process into the local Passings queue."""
+
+    def __init__(self, stopEvent=None, clientQueue=None, socketPath=None):
+        super(FrameReceiver, self).__init__(stopEvent=stopEvent, name='FrameReceiver')
+        self.clientQueue = clientQueue
+        self.socketPath = socketPath
+        self.sock = None
+
+    def connect(self):
+        # The publisher may not be listening yet.
+        while not self.stopEvent.is_set():
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.socketPath)
+                return sock
+            except OSError:
+                sock.close()
+                self.stopEvent.wait(0.2)
+        return None
+
+    def work(self):
+        if self.sock is None:
+            self.sock = self.connect()
+            if self.sock is None:
+                return
+            log("FrameReceiver.work: connected: %s" % (self.socketPath))
+        frame = readFrame(self.sock)
+        if frame is None:
+            # The ingest process has gone away, so should we.
+            log("FrameReceiver.work: EOF")
+            self.stopEvent.set()
+            return
+        self.clientQueue.put(frame)
+
+    def stop(self):
+        if self.sock:
+            closeSocket(self.sock)
+
+
+def workerMain(index, socketPath, port, raceIds, keepFinished):
+    # Imported here, the worker does not need the ingest side.
+    from .wsserver import WSServer, Passings
+    from .clientqueue import ClientQueue
+
+    stopEvent = Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)        # The ingest process handles ^C and closes the socket.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopEvent.set())
+    log("workerMain[%d]: pid: %d port: %d" % (index, os.getpid(), port))
+
+    # Unbounded, a dropped row could not be resent.  The rows come from the
+    # publisher, which only holds the frames since the last baseline anyway.
+    clientQueue = ClientQueue(maxsize=0)
+    passings = Passings(stopEvent=stopEvent, clientQueue=clientQueue, raceIds=raceIds, keepFinished=keepFinished)
+    wsserver = WSServer(stopEvent=stopEvent, port=port, passings=passings, reusePort=True)
+    passings.wsserver = wsserver
+    receiver = FrameReceiver(stopEvent=stopEvent, clientQueue=clientQueue, socketPath=socketPath)
+
+    threads = [passings, wsserver, receiver]
+    [t.start() for t in threads]
+    stopEvent.wait()
+    log("workerMain[%d]: stopping" % (index))
+    for t in threads:
+        t.stop()
+    for t in threads:
+        t.join(timeout=5)
+
+
+def startWorkers(workers, socketPath, port, raceIds, keepFinished):
+    # Spawn rather than fork, the ingest process may already be running threads.
+    ctx = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(workers):
+        p = ctx.Process(target=workerMain, args=(index, socketPath, port, raceIds, keepFinished), name='racemgr-worker-%d' % index)
+        p.start()
+        processes.append(p)
+    return processes
+
+
+def stopWorkers(processes, timeout=5):
+    for p in processes:
+        p.join(timeout=timeout)
+        if p.is_alive():
+            log("stopWorkers: terminating: %s" % (p.name))
+            p.terminate()
+            p.join()
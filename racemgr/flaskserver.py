@@ -8,6 +8,7 @@ from datetime import timedelta
 import datetime
 import signal
 import traceback
+from threading import Event, Lock
 
 
 from werkzeug.serving import make_server
@@ -16,7 +17,10 @@ import logging
 from flask.logging import default_handler
 
 from .threadex import ThreadEx
-from .utils import log
+from .httpcache import EncodedBody, makeResponse, notModified, streamResponse
+from .snapshot import MIMETYPES
+from .profiler import timers
+from .utils import log, HTTP_SERVERS
 
 #def get_host_info():
 #    try:
@@ -36,33 +40,211 @@ from .utils import log
 class FlaskServer(ThreadEx):
     #app1 = Flask(__name__)
 
-    def index(self):
-        return render_template('index.html', ws_port=self.dataport)
+    # The requests are small and served from the in-memory page and snapshot
+    # caches, so the threaded werkzeug server keeps up with a crowd of phones
+    # and every thread sees the live race data.  single is for debugging.
 
-    def __init__(self, stopEvent=None, webport=None, dataport=None ):
+    # The spectator page only changes when the configuration changes, allow
+    # phones to reuse it for a minute and revalidate with the ETag after that.
+    pageCacheControl = 'public, max-age=60'
+
+    def renderPage(self, template, **context):
+        # Render once per configuration and keep the compressed variants in memory.
+        key = (template, tuple(sorted(context.items())))
+        if key not in self.pages:
+            with self.app.app_context():
+                body = render_template(template, **context)
+            self.pages[key] = EncodedBody(body, 'text/html').precompress()
+            log('FlaskServer.renderPage: %s %s etag: %s' % (template, context, self.pages[key].etag))
+        return self.pages[key]
+
+    def index(self, raceId=''):
+        if raceId and (self.races is None or self.races.get(raceId) is None):
+            return Response('Unknown race: %s\n' % raceId, status=404, mimetype='text/plain')
+        return makeResponse(request, self.renderPage('index.html', ws_port=self.dataport, race_id=raceId), cacheControl=self.pageCacheControl)
+
+    # Snapshot API, race data changes with every CrossMgr version.
+    apiCacheControl = 'no-cache'
+
+    def apiUnavailable(self):
+        if self.races is None:
+            return Response('Snapshot API not available\n', status=503, mimetype='text/plain')
+        return None
+
+    def api(self, name, fmt, raceId=None):
+        response = self.apiUnavailable()
+        if response is not None:
+            return response
+        store = self.races.get(raceId)
+        if store is None:
+            return Response('Unknown race: %s\n' % raceId, status=404, mimetype='text/plain')
+        snapshot = store.current()
+        if snapshot is None:
+            return Response('No race data yet\n', status=503, mimetype='text/plain')
+
+        entry = store.cached(snapshot, name, fmt)
+        if entry:
+            return makeResponse(request, entry, cacheControl=self.apiCacheControl)
+
+        # The ETag is keyed to the versionCount, so we can answer without encoding anything.
+        etag = store.etag(snapshot, name, fmt)
+        response = notModified(request, etag, cacheControl=self.apiCacheControl)
+        if response is not None:
+            return response
+
+        # First request for this version, stream it out and cache it on the way.
+        chunks = store.encode(snapshot, name, fmt, EncodedBody)
+        return streamResponse(request, etag, MIMETYPES[fmt], chunks, cacheControl=self.apiCacheControl)
+
+    def apiRaces(self):
+        response = self.apiUnavailable()
+        if response is not None:
+            return response
+        response = Response(json.dumps(self.races.races()), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def apiAnalytics(self, raceId=None):
+        response = self.apiUnavailable()
+        if response is not None:
+            return response
+        store = self.races.get(raceId)
+        if store is None or store.analytics is None:
+            return Response('No analytics for race: %s\n' % raceId, status=404, mimetype='text/plain')
+        bibs = set(b.strip() for b in ','.join(request.args.getlist('bib')).split(',') if b.strip())
+        result = store.analytics.query(bibs=bibs, category=request.args.get('category'))
+        response = Response(json.dumps(result), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def apiSearch(self, raceId=None):
+        response = self.apiUnavailable()
+        if response is not None:
+            return response
+        store = self.races.get(raceId)
+        if store is None or store.search is None:
+            return Response('No rider search for race: %s\n' % raceId, status=404, mimetype='text/plain')
+        results = store.search.search(request.args.get('q', ''), category=request.args.get('category'),
+                                      limit=request.args.get('limit', type=int))
+        response = Response(json.dumps({'q': request.args.get('q', ''), 'results': results}), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def apiStatus(self):
+        response = self.apiUnavailable()
+        if response is not None:
+            return response
+        status = {'connections': self.races.status()}
+        if hasattr(self.clientQueue, 'status'):
+            status['queue'] = self.clientQueue.status()
+        response = Response(json.dumps(status), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    # Profiler control, only for requests from this machine.
+    def profileUnavailable(self):
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            return Response('Forbidden\n', status=403, mimetype='text/plain')
+        if self.profiler is None:
+            return Response('Profiler not available\n', status=503, mimetype='text/plain')
+        return None
+
+    def profile(self, action):
+        response = self.profileUnavailable()
+        if response is not None:
+            return response
+        if action == 'start':
+            timers.enabled = True
+            self.profiler.startSampling()
+        elif action == 'stop':
+            timers.enabled = False
+            self.profiler.stopSampling()
+        elif action == 'reset':
+            timers.reset()
+            self.profiler.reset()
+        return self.profileStatus()
+
+    def profileStatus(self):
+        response = self.profileUnavailable()
+        if response is not None:
+            return response
+        status = dict(self.profiler.status(), timers=timers.report(), functions=self.profiler.functions())
+        response = Response(json.dumps(status, indent=1), mimetype='application/json')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def profileFolded(self):
+        response = self.profileUnavailable()
+        if response is not None:
+            return response
+        response = Response(self.profiler.folded(), mimetype='text/plain')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def __init__(self, stopEvent=None, webport=None, dataport=None, httpServer='threaded', races=None, profiler=None, clientQueue=None ):
         super(FlaskServer, self).__init__(stopEvent=stopEvent, name='FlaskServer')
         self.app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
         #self.hostInfo = get_host_info()
 
         self.dataport = dataport
         self.webport = webport
+        self.pages = {}
+        self.httpServer = httpServer
+        self.races = races              # RaceRegistry
+        self.profiler = profiler        # SamplingProfiler
+        self.clientQueue = clientQueue  # ClientQueue, for its counters
         # this gets rid of the werkzeug logging which defaults to logging GET requests
         wlog = logging.getLogger('werkzeug')
         wlog.setLevel(logging.ERROR)
 
         self.app.add_url_rule('/', 'root', self.index)
+        self.app.add_url_rule('/race/<path:raceId>', 'race', self.index)
+        self.app.add_url_rule('/api/races.json', 'races', self.apiRaces)
+        self.app.add_url_rule('/api/status.json', 'status', self.apiStatus)
+        self.app.add_url_rule('/api/analytics.json', 'analytics', self.apiAnalytics)
+        self.app.add_url_rule('/api/<path:raceId>/analytics.json', 'raceAnalytics', self.apiAnalytics)
+        self.app.add_url_rule('/api/search.json', 'search', self.apiSearch)
+        self.app.add_url_rule('/api/<path:raceId>/search.json', 'raceSearch', self.apiSearch)
+        self.app.add_url_rule('/profile/status.json', 'profileStatus', self.profileStatus)
+        self.app.add_url_rule('/profile/folded.txt', 'profileFolded', self.profileFolded)
+        self.app.add_url_rule('/profile/<any(start, stop, reset):action>', 'profile', self.profile, methods=['POST'])
+        self.app.add_url_rule('/api/<any(passings, leaders, race):name>.<any(json, csv):fmt>', 'api', self.api)
+        self.app.add_url_rule('/api/<path:raceId>/<any(passings, leaders, race):name>.<any(json, csv):fmt>', 'raceApi', self.api)
 
-        self.server = make_server('0.0.0.0', self.webport, self.app)
+        # The socket is bound, and the page rendered, in work() so they do not hold up startup.
+        self.lock = Lock()
+        self.server = None
+        self.closed = False
+        log('FlaskServer.__init__: httpServer: %s' % (httpServer))
+
+    def bind(self):
+        # Render before serving so the first burst of requests all hit the cache.
+        self.renderPage('index.html', ws_port=self.dataport, race_id='')
+        return make_server('0.0.0.0', self.webport, self.app, threaded=self.httpServer == 'threaded')
 
     def work(self):
+        with self.lock:
+            if self.closed:
+                return
+            if self.server is None:
+                try:
+                    self.server = self.bind()
+                except OSError as e:
+                    log('FlaskSever.work: port %s: %s' % (self.webport, e))
+                    self.stopEvent.set()
+                    return
         log('FlaskSever.run: Starting server', )
         self.server.serve_forever()
         log('FlaskSever.run: server started', )
 
     def shutdown(self):
         log('FlaskSever.Stopping server', )
-        self.server.shutdown()
-        self.server.server_close()
+        with self.lock:
+            self.closed = True
+            server = self.server
+        if server is not None:
+            server.shutdown()
+            server.server_close()
         #self.ctx.pop()
 
 def main():
@@ -0,0 +1,102 @@
+import gzip
+import hashlib
+from threading import Lock
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .utils import log
+
+
+# Content encodings we can produce, in order of preference.
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+class EncodedBody:
+    """A response body held in memory together with its compressed variants.
+
+    The ETag is a strong validator derived from the identity body, each
+    compressed variant gets its own ETag (a byte-for-byte different
+    representation must not share a strong ETag).
+    """
+
+    def __init__(self, body, mimetype, etag=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.mimetype = mimetype
+        self.etag = etag or hashlib.sha1(body).hexdigest()
+        self.variants = {'identity': body}
+        self.lock = Lock()
+
+    def precompress(self):
+        for encoding in ENCODINGS:
+            self.encoded(encoding)
+        return self
+
+    def encoded(self, encoding):
+        # Compress lazily, once per encoding.
+        if encoding not in self.variants:
+            with self.lock:
+                if encoding not in self.variants:
+                    body = self.variants['identity']
+                    if encoding == 'br':
+                        self.variants[encoding] = brotli.compress(body)
+                    elif encoding == 'gzip':
+                        self.variants[encoding] = gzip.compress(body, compresslevel=9, mtime=0)
+                    log('EncodedBody.encoded: %s %d -> %d' % (encoding, len(body), len(self.variants[encoding])))
+        return self.variants[encoding]
+
+    def variantETag(self, encoding):
+        return variantETag(self.etag, encoding)
+
+
+def variantETag(etag, encoding):
+    return etag if encoding == 'identity' else '%s-%s' % (etag, encoding)
+
+
+def chooseEncoding(request):
+    for encoding in ENCODINGS:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+
+def setHeaders(response, etag, cacheControl):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cacheControl
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def notModified(request, etag, cacheControl='no-cache'):
+    """Return a 304 response if the client already has any representation of this entity.
+
+    The variants only differ in their content encoding.  A client that was
+    sent the streamed (identity) body and now accepts gzip still has it.
+    """
+    for encoding in [e for e in ENCODINGS if request.accept_encodings[e]] + ['identity']:
+        variant = variantETag(etag, encoding)
+        if request.if_none_match.contains(variant):
+            return setHeaders(Response(status=304), variant, cacheControl)
+    return None
+
+
+def makeResponse(request, entry, cacheControl='no-cache'):
+    """Serve an EncodedBody with content negotiation and conditional GET support."""
+    response = notModified(request, entry.etag, cacheControl)
+    if response is not None:
+        return response
+    encoding = chooseEncoding(request)
+    response = Response(entry.encoded(encoding), mimetype=entry.mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    return setHeaders(response, entry.variantETag(encoding), cacheControl)
+
+
+def streamResponse(request, etag, mimetype, chunks, cacheControl='no-cache'):
+    """Stream an uncompressed body while it is being generated."""
+    return setHeaders(Response(chunks, mimetype=mimetype), etag, cacheControl)
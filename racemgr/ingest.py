@@ -0,0 +1,122 @@
+import re
+import json
+import tracemalloc
+from time import perf_counter
+
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Incremental decoding of CrossMgr messages.
+#
+# A late race baseline has an "info" entry for every rider with the full
+# raceTimes and interp arrays plus a lot of reference data we never look at.
+# json.loads() builds all of it before we get a chance to throw any away.
+#
+# decodeMessage() walks the top level object itself.  The rider maps
+# ("info", and "a"/"m" of "infoRAM") are decoded one rider at a time and only
+# the fields racemgr uses are kept, so at most one full rider is alive at a
+# time.  Everything else is decoded with the C decoder as usual.
+#
+
+# Rider fields used by racemgr, everything else is dropped at decode time.
+RIDER_FIELDS = frozenset(['status', 'raceTimes', 'interp', 'FirstName', 'LastName', 'Team', ])
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+decoder = json.JSONDecoder()
+
+
+def skip(text, idx):
+    return WHITESPACE.match(text, idx).end()
+
+
+def decodeObject(text, idx, decodeValue):
+    """Decode the object at text[idx], calling decodeValue(key, text, idx) for each value."""
+    idx = skip(text, idx)
+    if text[idx] != '{':
+        raise ValueError('Expecting object at %d' % idx)
+    result = {}
+    idx = skip(text, idx + 1)
+    if text[idx] == '}':
+        return result, idx + 1
+    while True:
+        key, idx = decoder.raw_decode(text, idx)
+        idx = skip(text, idx)
+        if text[idx] != ':':
+            raise ValueError('Expecting ":" at %d' % idx)
+        idx = skip(text, idx + 1)
+        result[key], idx = decodeValue(key, text, idx)
+        idx = skip(text, idx)
+        if text[idx] == ',':
+            idx = skip(text, idx + 1)
+        elif text[idx] == '}':
+            return result, idx + 1
+        else:
+            raise ValueError('Expecting "," or "}" at %d' % idx)
+
+
+def decodeAny(key, text, idx):
+    return decoder.raw_decode(text, idx)
+
+
+class MessageDecoder:
+
+    def __init__(self, riderFields=RIDER_FIELDS, stats=False):
+        self.riderFields = riderFields
+        self.stats = stats              # Log the tracemalloc memory, see --ingest-stats.
+        self.messages = 0
+        self.riders = 0
+        self.dropped = 0                # Rider fields dropped by the last decode.
+
+    def decodeRider(self, key, text, idx):
+        rider, idx = decoder.raw_decode(text, idx)
+        self.riders += 1
+        if isinstance(rider, dict):
+            slim = {k: v for k, v in rider.items() if k in self.riderFields}
+            self.dropped += len(rider) - len(slim)
+            rider = slim
+        return rider, idx
+
+    def decodeRiders(self, key, text, idx):
+        return decodeObject(text, idx, self.decodeRider)
+
+    def decodeRAM(self, key, text, idx):
+        return decodeObject(text, idx, lambda k, text, idx: self.decodeRiders(k, text, idx) if k in ('a', 'm') else decodeAny(k, text, idx))
+
+    def decodeTop(self, key, text, idx):
+        if key == 'info':
+            return self.decodeRiders(key, text, idx)
+        if key == 'infoRAM':
+            return self.decodeRAM(key, text, idx)
+        return decodeAny(key, text, idx)
+
+    def decode(self, text):
+        if isinstance(text, (bytes, bytearray)):
+            text = text.decode('utf-8')
+        self.riders = self.dropped = 0
+        start = perf_counter()
+        message, idx = decodeObject(text, 0, self.decodeTop)
+        if skip(text, idx) != len(text):
+            raise ValueError('Extra data at %d' % idx)
+        elapsed = perf_counter() - start
+        self.messages += 1
+        # tracemalloc is process wide, it is started once by raceMain and
+        # shared by all the feeds, so this is the whole process, not the decode.
+        memory = ''
+        if self.stats and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            memory = ' traced: %.1f MB peak: %.1f MB' % (current / 1e6, peak / 1e6)
+        log('MessageDecoder.decode[%d]: %d bytes %.1f ms riders: %d dropped fields: %d%s' % (
+            self.messages, len(text), elapsed * 1000, self.riders, self.dropped, memory))
+        return message
+
+    def decodeRecorded(self, text):
+        """Decode a line of a recording, {"time": t, "data": message}, returns (t, message)."""
+        self.riders = self.dropped = 0
+        record, idx = decodeObject(text, 0, lambda k, text, idx: decodeObject(text, idx, self.decodeTop) if k == 'data' else decodeAny(k, text, idx))
+        if skip(text, idx) != len(text):
+            raise ValueError('Extra data at %d' % idx)
+        self.messages += 1
+        return record.get('time'), record['data']
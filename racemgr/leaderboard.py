@@ -0,0 +1,88 @@
+import json
+
+from .utils import log, hhmmss
+
+
+#-----------------------------------------------------------------------
+#
+# Live top N leaderboard per category.
+#
+# The boards are maintained incrementally.  After a RAM update only the
+# categories named in categoryRAM (or whose top N riders changed name or
+# team in infoRAM) are rebuilt, and a category is only reported as changed
+# if its top N rows are actually different.
+#
+
+LEADER_HEADERS = ('Rank', 'Bib', 'Name', 'Team', 'Gap', )
+
+
+def gapStr(gapValue):
+    # CrossMgr reports the gap to the leader in seconds, or laps down as a negative number.
+    if not gapValue:
+        return ''
+    if gapValue < 0:
+        return '-%d %s' % (-gapValue, 'lap' if gapValue == -1 else 'laps')
+    return '+%s' % hhmmss(gapValue)
+
+
+class Leaderboard:
+
+    def __init__(self, showTop=10):
+        self.showTop = showTop
+        self.boards = {}                # Category name -> (iSort, tuple of rows)
+
+    def reset(self):
+        self.boards = {}
+
+    def rows(self, cat, info):
+        gaps = cat.get('gapValue') or []
+        rows = []
+        for rank, bib in enumerate(cat['pos'][:self.showTop], 1):
+            r = info.get(str(bib), {})    # Access as a string, not an integer.
+            gap = gapStr(gaps[rank - 1]) if rank > 1 and rank <= len(gaps) else ''
+            rows.append((rank, bib, r.get('FirstName', ''), r.get('LastName', ''), r.get('Team', ''), gap, ))
+        return tuple(rows)
+
+    def categoriesForBibs(self, bibs):
+        # Categories currently showing any of these bibs.
+        bibs = set(str(bib) for bib in bibs)
+        return [name for name, (iSort, rows) in self.boards.items() if any(str(row[1]) in bibs for row in rows)]
+
+    def update(self, categoryDetails, info, categories=None):
+        """Rebuild the named categories (all if None), return the names whose top N changed."""
+        if categories is None:
+            categories = set(categoryDetails.keys()) | set(self.boards.keys())
+        changed = []
+        for name in categories:
+            cat = categoryDetails.get(name)
+            if cat is None or cat['iSort'] == 0:    # Removed, or the 'All' category which has iSort=0.
+                if self.boards.pop(name, None) is not None:
+                    changed.append(name)
+                continue
+            board = (cat['iSort'], self.rows(cat, info))
+            if self.boards.get(name) != board:
+                self.boards[name] = board
+                changed.append(name)
+        log('Leaderboard.update: categories: %d changed: %s' % (len(categories), changed))
+        return changed
+
+    def message(self, name):
+        iSort, rows = self.boards.get(name, (0, ()))
+        return json.dumps({
+            "type": "leaders",
+            "category": name,
+            "iSort": iSort,
+            "headers": LEADER_HEADERS,
+            "rows": [[rank, bib, '%s,%s' % (LastName, FirstName), Team, gap] for rank, bib, FirstName, LastName, Team, gap in rows],
+        })
+
+    def leaders(self):
+        # All boards in CrossMgr order, for snapshots and printTop.
+        return [
+            {
+                'category': name,
+                'riders': [{'rank': rank, 'bib': bib, 'FirstName': FirstName, 'LastName': LastName, 'Team': Team, 'gap': gap}
+                           for rank, bib, FirstName, LastName, Team, gap in rows],
+            }
+            for name, (iSort, rows) in sorted(self.boards.items(), key=lambda item: item[1][0])
+        ]
@@ -4,11 +4,18 @@ import time
 from time import time, sleep
 import datetime
 import operator
-import websocket
 import traceback
+from threading import Event
 
 from .threadex import ThreadEx
-from .utils import log
+from .snapshot import RaceSnapshot
+from .leaderboard import Leaderboard
+from .expected import ExpectedArrivals
+from .analytics import RaceAnalytics
+from .search import RiderIndex
+from .ingest import MessageDecoder
+from .profiler import timed
+from .utils import log, hhmmss, find_last_false
 
 
 #-----------------------------------------------------------------------
@@ -48,6 +55,12 @@ from .utils import log
 
 PORT_NUMBER = 8765 + 1    # CrossMgr announter port.
 
+RECORDED_HEADERS = ('Bib', 'Note', 'Time', 'Gap', 'Lap', 'Lap Time', 'Behind', 'Name', 'Wave', '#', )
+
+# Clients run the race clock locally from an anchor (race time at a wall clock time).
+# A new anchor is only sent when the state changes or CrossMgr drifts this far from it.
+CLOCK_DRIFT = 1.0
+
 riders = {}
 
 def applyRAM( dest, ram ):
@@ -62,12 +75,6 @@ def applyRAM( dest, ram ):
     for k in ram['r']:
         dest.pop( k, None )    # Use pop instead of del (safer).
 
-def hhmmss( raceTime ):
-    seconds = round(raceTime)
-    minutes = seconds // 60
-    hours = seconds // 3600
-    return '%02d:%02d' % (minutes, seconds % 60)
-
 def lap_position_str(lap_position):
     #log('lap_position_str: %s' % (lap_position))
     if lap_position == 1:
@@ -81,29 +88,37 @@ def lap_position_str(lap_position):
 
 
 class SynchronizedRaceData:
-    def __init__( self, crossmgr='localhost', port=PORT_NUMBER, clientQueue=None, save=None, replay=None ):
+    def __init__( self, crossmgr='localhost', port=PORT_NUMBER, clientQueue=None, save=None, replay=None, snapshots=None, showLeaders=10, expectedWindow=60, raceId=None, ingestStats=False, connectionOptions=None ):
         self.info = {}                    # Reference data accessed by bib number.
         self.categoryDetails = {}        # Category details accessed by category name.  Includes current position of all participats.
 
-        log('SynchronizedRaceData: crossmgr: %s save: %s' % (crossmgr, save))
+        log('SynchronizedRaceData: raceId: %s crossmgr: %s save: %s' % (raceId, crossmgr, save))
+        self.raceId = raceId if raceId is not None else crossmgr    # Identifies this feed to Passings and the HTTP API.
         self.save = save
         self.replay = replay
         
         self.clientQueue = clientQueue
+        self.snapshots = snapshots
         self.clientQueuePut('race_info', json.dumps({
             "type": "definition",
             "title": '',
             # XXX
             # "headers": ('Bib', 'Note', 'Time', 'Gap', 'Lap', 'Name', 'Wave' ),
-            "headers": ('Bib', 'Note', 'Time', 'Gap', 'Lap', 'Name', 'Wave', '#', ),
+            "headers": RECORDED_HEADERS,
         }))
         self.raceName = ''                # Name of current race.
         self.versionCount = -1            # Current version of the local race.
+        self.raceIsRunning = False
+        self.raceIsUnstarted = True
+        self.raceIsFinished = False
+        self.timestamp = None
+        self.curRaceTime = 0
 
         self.filename = None
         self.jsonFile = None
+        self.fd = None
         if self.save:
-            self.filename = datetime.datetime.now().strftime('%Y%m%d_%H%M%S.json')
+            self.filename = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_') + ''.join(c if c.isalnum() else '_' for c in self.raceId) + '.json'
             self.jsonFile = open(self.filename, 'w')
             log('SynchronizedRaceData: save: %s' % (self.filename))
 
@@ -118,8 +133,27 @@ class SynchronizedRaceData:
         self.last_racetime = {}
         #self.passings = []
         self.recorded = {}
+        self.recordedCount = 0
+        self.leaderboard = Leaderboard(showTop=showLeaders)
+        self.expected = ExpectedArrivals(window=expectedWindow)
+        self.analytics = RaceAnalytics()
+        self.riderIndex = RiderIndex()
+        self.decoder = MessageDecoder(stats=ingestStats)
+        self.clockAnchor = None
         self.keepalives = 0
 
+        self.baselinePending = False
+        self.connection = None
+        self.connectionOptions = connectionOptions or {}
+        self.connectionStats = {
+            'connects': 0, 'reconnects': 0, 'connectFailures': 0,
+            'baselinesRequested': 0, 'baselinesReceived': 0, 'resumes': 0, 'deadLinks': 0,
+        }
+        if self.snapshots is not None:
+            self.snapshots.stats = self.connectionStats
+            self.snapshots.analytics = self.analytics
+            self.snapshots.search = self.riderIndex
+
         self.showFlag = False
 
     #def wsserverSend(self, message):
@@ -127,9 +161,11 @@ class SynchronizedRaceData:
     #    self.clientQueue.put(message)
     
     def clientQueuePut(self, dataType, message):
+        if self.clientQueue is None:
+            return                      # Headless, no WebSocket server.
         try:
-            log("SynchronizedRaceData.clientQueue[%s] %s PUT" % (dataType, message,))
-            self.clientQueue.put((dataType, message))
+            log("SynchronizedRaceData.clientQueue[%s:%s] %s PUT" % (self.raceId, dataType, message,))
+            self.clientQueue.put((self.raceId, dataType, message))
         except Exception as e:
             log("SynchronizedRaceData.clientQueue[%s] %s PUT FAILED" % (dataType, e,))
             print(traceback.format_exc(), file=sys.stderr)
@@ -149,12 +185,13 @@ class SynchronizedRaceData:
             self.last_racetime = {}
             #self.passings = []
             self.recorded = {}
-            self.clientQueuePut('baseline', '')
+            self.recordedCount = 0
+            self.clientQueuePut('baseline', self.raceName)
             self.clientQueuePut('race_info', json.dumps({
                 "type": "definition",
                 "title": self.raceName,
                 # "headers": ('Bib', 'Note', 'Time', 'Gap', 'Lap', 'Name', 'Wave' ),
-                "headers": ('Bib', 'Note', 'Time', 'Gap', 'Lap', 'Name', 'Wave', '', ),
+                "headers": RECORDED_HEADERS,
             }))
 
         #self.clientQueuePut('categoryDetails', self.categoryDetails.keys())
@@ -176,60 +213,100 @@ class SynchronizedRaceData:
                 for i, (k, v) in enumerate(self.info.items()):
                     #log('info[%d][%4s] %s ' % (i, k, v['interp']))
                     #log('info[%d][%4s] %s ' % (i, k, v['raceTimes']))
-                    log('info[%d][%20s][%4s] %s ' % (i, v['raceCat'], k, v['raceTimes'][:self.find_last_false(v['interp'])]))
+                    log('info[%d][%20s][%4s] %s ' % (i, v['raceCat'], k, v['raceTimes'][:find_last_false(v['interp'])]))
             except Exception as e:
                 log('setRaceState: error: %s' % (e))
                 print(traceback.format_exc(), file=sys.stderr)
                 exit(1)
     
+    @timed('processBaseline')
     def processBaseline( self, message ):
         # XXX
         log('processBaseline: %s' % (message.keys()))
         self.info = message['info']
         self.categoryDetails = message['categoryDetails']
         self.setRaceState( message, reset=True )
+        # The baseline resets the clients' race state, clock included, so send the anchor again.
+        self.clockAnchor = None
+        self.publishClock( message['reference'] )
         self.baselinePending = False
+        self.connectionStats['baselinesReceived'] += 1
+        self.leaderboard.reset()
+        self.publishLeaders( self.leaderboard.update( self.categoryDetails, self.info ) )
+        self.expected.reset()
+        self.analytics.reset()
+        self.riderIndex.load( self.info )
+        for bib in self.info.keys():
+            self.updateExpected( bib )
+            self.analytics.updateRider( bib, self.info[bib] )
     
+    @timed('processRAM')
     def processRAM( self, message ):
         log('processRAM: %s' % (message.keys()))
+        riderCategories = dict(self.riderCategories)
         applyRAM( self.info, message['infoRAM'] )
         applyRAM( self.categoryDetails, message['categoryRAM'] )
         self.setRaceState( message, reset=False )
 
+        # Only rebuild the categories that changed, or that show a rider whose name or team changed.
+        categoryRAM, infoRAM = message['categoryRAM'], message['infoRAM']
+        categories = set(categoryRAM['a']) | set(categoryRAM['m']) | set(categoryRAM['r'])
+        categories.update( self.leaderboard.categoriesForBibs( list(infoRAM['a']) + list(infoRAM['m']) ) )
+        self.publishLeaders( self.leaderboard.update( self.categoryDetails, self.info, categories ) )
+
+        # Only the riders with new passings, or that moved to another category, need a new estimate and lap times.
+        bibs = set(str(bib) for bib in list(infoRAM['a']) + list(infoRAM['m']))
+        bibs.update( bib for bib, raceCat in self.riderCategories.items() if riderCategories.get(bib) != raceCat )
+        for bib in bibs:
+            self.updateExpected( bib )
+            data = self.info.get(str(bib))
+            self.analytics.updateRider( bib, data )
+            if data is None:
+                self.riderIndex.removeRider( bib )
+            else:
+                self.riderIndex.updateRider( bib, data )
+        for bib in infoRAM['r']:
+            self.expected.removeRider( bib )
+            self.analytics.removeRider( bib )
+            self.riderIndex.removeRider( bib )
+
+    def updateExpected( self, bib ):
+        data = self.info.get(str(bib))
+        if data is None:
+            self.expected.removeRider( bib )
+            return
+        self.expected.updateRider( bib, data, self.categoryDetails.get(data.get('raceCat'), {}).get('laps') )
+
+    def publishClock( self, reference ):
+        raceTime, running, finished = reference['curRaceTime'], reference['raceIsRunning'], reference['raceIsFinished']
+        now = time()
+        anchor = self.clockAnchor
+        if anchor and anchor['running'] == running and anchor['finished'] == finished:
+            predicted = anchor['raceTime'] + (now - anchor['wallTime'] if running else 0)
+            if abs(predicted - raceTime) < CLOCK_DRIFT:
+                return
+        self.clockAnchor = {'type': 'race_clock', 'raceTime': raceTime, 'wallTime': now, 'running': running, 'finished': finished, 'time': hhmmss(raceTime), }
+        self.clientQueuePut('race_time', json.dumps(self.clockAnchor))
+
+    def publishExpected( self ):
+        message = self.expected.feed( self.curRaceTime )
+        if message:
+            self.clientQueuePut('expected', message)
+
+    def publishLeaders( self, categories ):
+        for name in categories:
+            self.clientQueuePut('leaders', self.leaderboard.message(name))
+
     def printTop( self ):
         # Example "do something" with the results.
         showTop = 5
         print( '********* Top {} Leaders ********* {}'.format(showTop, datetime.datetime.now()), file=sys.stderr )
-        # Sort the categoryDetails by "iSort" so they come out in the same order as CrossMgr.
-        for cat in sorted( self.categoryDetails.values(), key=operator.itemgetter('iSort') ):
-            if cat['iSort'] == 0:    # Ignore the 'All' category has iSort=0.
-                continue
-            print( cat['name'], file=sys.stderr )
-            for rank, bib in enumerate(cat['pos'][:showTop], 1):
-                # Get the reference information for this bib number.
-                r = self.info.get(str(bib), {})    # Access as a string, not an integer.
-                print( '{}. {:4d}: {} {} ({})'.format( rank, bib, r.get('FirstName', ''), r.get('LastName', ''), r.get('Team','') ), file=sys.stderr)
-    
-    def find_last_false(self, arr):
-        try:
-            # Reverse the list and find the first True, then calculate the original index
-            return len(arr) - 1 - arr[::-1].index(False)
-        except ValueError:
-            # If there's no True value, return -1 or any value indicating "not found"
-            return -1
-    def find_last_true(self, arr):
-        try:
-            # Reverse the list and find the first True, then calculate the original index
-            return len(arr) - 1 - arr[::-1].index(True)
-        except ValueError:
-            # If there's no True value, return -1 or any value indicating "not found"
-            return -1
-
-    # Example usage
-    #boolean_array = [False, True, False, True, False]
-    #print(find_last_true(boolean_array))  # Output: 3
-
+        for cat in self.leaderboard.leaders():
+            print( cat['category'], file=sys.stderr )
+            for r in cat['riders'][:showTop]:
+                print( '{}. {:4d}: {} {} ({})'.format( r['rank'], r['bib'], r['FirstName'], r['LastName'], r['Team'] ), file=sys.stderr)
 
+    @timed('generate_leaders')
     def generate_leaders(self, sorted_passings):
         leaders = {}
         leader_laps = {}
@@ -273,7 +350,7 @@ class SynchronizedRaceData:
             new_sorted_passings.append({
                 "type": "row",
                 'rowIndex' : None,
-                "row": [bib, lap_position, seconds, down, lap, name, raceCat, ],
+                "row": [bib, lap_position, seconds, down, lap, ] + self.analytics.passingColumns(bib, lap) + [name, raceCat, ],
             })
             log('generate_leaders: %s' % (new_sorted_passings[-1]))
             continue
@@ -311,6 +388,7 @@ class SynchronizedRaceData:
     #print(leaders)
 
 
+    @timed('printRecent')
     def printRecent( self ):
         # Example "do something" with the results.
         showTop = 5
@@ -337,7 +415,7 @@ class SynchronizedRaceData:
 
             interp = data['interp']
             #print('interp: %s' % (str(interp)), file=sys.stderr)
-            last_interp = self.find_last_false(interp)
+            last_interp = find_last_false(interp)
             FirstName = data['FirstName']
             LastName = data['LastName']
             name = f"{LastName},{FirstName}"
@@ -355,6 +433,8 @@ class SynchronizedRaceData:
         laps = 0
         position = 1
         update = []
+        self.recordedCount = len(final_sorted_passings)
+        riderRows = {}
         for index, passing in enumerate(final_sorted_passings):
 
         
@@ -362,6 +442,7 @@ class SynchronizedRaceData:
             passing['row'][1] = lap_position_str(passing['row'][1])
             passing['row'][2] = hhmmss(passing['row'][2])
             passing['row'].append(str(index))
+            riderRows.setdefault(str(passing['row'][0]), []).append(passing['row'])
 
             if index in self.recorded and self.recorded[index] == passing:
                 continue
@@ -371,29 +452,88 @@ class SynchronizedRaceData:
             log('passing[%d]: %s' % (index, str(passing)))
             update.append(json.dumps(passing))
 
+        # Replaced as a whole, the search runs in other threads.
+        self.riderIndex.riderRows = riderRows
+
         for passing in update:
             self.clientQueuePut('recorded', passing)
 
 
         return
 
+    def raceInfo( self ):
+        return {
+            'raceName': self.raceName,
+            'versionCount': self.versionCount,
+            'raceIsRunning': self.raceIsRunning,
+            'raceIsUnstarted': self.raceIsUnstarted,
+            'raceIsFinished': self.raceIsFinished,
+            'timestamp': self.timestamp,
+            'curRaceTime': self.curRaceTime,
+            'riders': len(self.info),
+            'categories': len(self.categoryDetails),
+        }
+
+    def snapshot( self ):
+        # Rows are replaced, never modified, by printRecent so the snapshot can share them.
+        rows = [self.recorded[index]['row'] for index in range(self.recordedCount)]
+        return RaceSnapshot(self.raceInfo(), RECORDED_HEADERS, rows, self.leaderboard.leaders())
+
+    def publishSnapshot( self ):
+        self.snapshots.publish(self.snapshot())
+
     def onChange( self ):
         # Called after any change.  Subclass to specialize.
         #print( 'onChange', file=sys.stderr )
         #self.printTop()
         self.printRecent()
+        if self.snapshots:
+            self.publishSnapshot()
+        self.publishExpected()
+        if hasattr(self.clientQueue, 'takeResync') and self.clientQueue.takeResync( self.raceId ):
+            if self.recordedCount < self.clientQueue.maxsize:
+                self.resyncClients()
+            else:
+                log('onChange: %s rows: %d do not fit in the client queue, no resync' % (self.raceId, self.recordedCount))
+
+    def resyncClients( self ):
+        # The ClientQueue had to drop a recorded row, send the whole race again as after a baseline.
+        log('resyncClients: %s rows: %d' % (self.raceId, self.recordedCount))
+        self.clientQueuePut('baseline', self.raceName)
+        self.clientQueuePut('race_info', json.dumps({
+            "type": "definition",
+            "title": self.raceName,
+            "headers": RECORDED_HEADERS,
+        }))
+        for index in range(self.recordedCount):
+            self.clientQueuePut('recorded', json.dumps(self.recorded[index]))
+        self.publishLeaders( list(self.leaderboard.boards.keys()) )
+        self.clockAnchor = None
+        self.publishClock( {'curRaceTime': self.curRaceTime, 'raceIsRunning': self.raceIsRunning, 'raceIsFinished': self.raceIsFinished} )
+        self.publishExpected()
 
     
+    def record( self, btext ):
+        # Save the message as received, no need to decode and re-encode it.
+        # Newlines in JSON can only be whitespace, so this keeps one message per line.
+        if isinstance(btext, (bytes, bytearray)):
+            btext = btext.decode('utf-8')
+        self.jsonFile.write('{"time": %r, "data": %s}\n' % (time(), btext.replace('\n', ' ')))
+
     def onMessage( self, ws, btext ):
         #print( btext, file=sys.stderr )
+        if self.jsonFile:
+            self.record( btext )
         try:
-            message = json.loads( btext )
+            message = self.decoder.decode( btext )
         except Exception as e:
             print( 'Error decoding message: %s' % (e), file=sys.stderr )
             print( traceback.format_exc(), file=sys.stderr )
             return
-        print(json.dumps({'time': time(), 'data': message }), file=self.jsonFile )
+        self.processMessage( ws, message )
 
+    def processMessage( self, ws, message ):
+        # A decoded CrossMgr message, from onMessage() or straight from a recording (see batch.py).
         log('message: %s' % ({k: len(message[k]) for k in message.keys()}))
         summary = {}
         for k in ['categoryRAM', 'infoRAM']:
@@ -403,7 +543,8 @@ class SynchronizedRaceData:
         if 'reference' in message:
             log('message: reference: %s' % (message['reference']))
             self.curRaceTime = message['reference']['curRaceTime']
-            self.clientQueuePut('race_time', json.dumps({'type': 'race_time', 'time': hhmmss(self.curRaceTime),}))
+            self.publishClock( message['reference'] )
+            self.publishExpected()
 
         if self.showFlag:
             self.showFlag = False
@@ -456,7 +597,7 @@ class SynchronizedRaceData:
                 # If the versionCount or raceName is out of sync.  Request a full update.
                 if self.versionCount + 1 != message['reference']['versionCount'] or self.raceName != message['reference']['raceName']:
                     if ws:
-                        ws.send( json.dumps({'cmd':'send_baseline', 'raceName':message['reference']['raceName']}).encode() )
+                        self.requestBaseline( ws, message['reference']['raceName'] )
                     self.baselinePending = True    # Set flag to ignore incremental updates until we get the new baseline.
                 else:
                     # Otherwise, it is safe to apply this update.
@@ -471,34 +612,19 @@ class SynchronizedRaceData:
         # Called after connection exceptions.  Subclass to specialize.
         print( e, file=sys.stderr )
     
+    def requestBaseline( self, ws, raceName ):
+        log("SynchronizedRaceData.requestBaseline: %s" % (raceName))
+        ws.send( json.dumps({'cmd':'send_baseline', 'raceName':raceName}).encode() )
+        self.connectionStats['baselinesRequested'] += 1
+        self.baselinePending = True
+
     def eventLoop( self, stopEvent=None ):
-        try:
-            log("SynchronizedRaceData.eventLoop crossmgr: %s" % (self.wsurl))
-            ws = websocket.create_connection( self.wsurl )
-        except ConnectionRefusedError as e:
-            log("SynchronizedRaceData.eventLoop ConnectionRefusedError: %s" % (e))
-            sleep( 1 )
-            return
-        try:    
-            #print('ws timeout: %s' % (ws.gettimeout()), file=sys.stderr)
-            ws.settimeout(4)
-            ws.send( json.dumps({'cmd':'send_baseline', 'raceName':'CurrentResults'}).encode() )
-            while not stopEvent.is_set():
-                try:
-                    self.onMessage( ws, ws.recv() )
-                except websocket.WebSocketTimeoutException:
-                    #print('timeout', file=sys.stderr)
-                    pass
-                #ws.send( json.dumps({'keepalive': self.keepalives,}).encode() )
-                #self.keepalives += 1
-            return
-        except Exception as e:
-            log("SynchronizedRaceData.eventLoop exception: %s" % (e))
-            print(traceback.format_exc(), file=sys.stderr)
-            #self.onException( e )
-            sleep( 1 )
-        finally:
-            pass
+        # One connection per call, the caller loops.  The CrossMgrConnection
+        # keeps the backoff state between calls.
+        if self.connection is None:
+            from .connection import CrossMgrConnection      # websocket-client is only needed for a live feed.
+            self.connection = CrossMgrConnection( self, stopEvent, **self.connectionOptions )
+        self.connection.run()
 
     def doReplay(self, ):
 
@@ -513,12 +639,14 @@ class SynchronizedRaceData:
                 return
         except:
             self.fd = None;
+            return
         #log('line: %s' % (line))
         try:
             onMessage = json.loads(line)
         except Exception as e:
             log('doReplay: %s' % (e))
             log(traceback.format_exc())
+            return
 
         log('onMessage: %s' % (str(onMessage.keys())))
         log('onMessage[%s] %s' % (onMessage['time'], str(onMessage['data'].keys())))
@@ -536,7 +664,7 @@ class SynchronizedRaceData:
 
 
 class LiveThread( ThreadEx ):
-    def __init__( self, stopEvent=None, crossmgr='192.168.40.12', clientQueue=None, save=None, replay=None ):
+    def __init__( self, stopEvent=None, crossmgr='192.168.40.12', clientQueue=None, save=None, replay=None, snapshots=None, showLeaders=10, expectedWindow=60, raceId=None, ingestStats=False, connectionOptions=None ):
 
         log("LiveThread.__init__ crossmgr: %s" % (crossmgr if crossmgr else "None"))
         self.crossmgr = crossmgr
@@ -545,13 +673,21 @@ class LiveThread( ThreadEx ):
         self.replay = replay
 
 
-        self.rd = SynchronizedRaceData(crossmgr=self.crossmgr, clientQueue=self.clientQueue, save=save, replay=replay)
+        self.rd = SynchronizedRaceData(crossmgr=self.crossmgr, clientQueue=self.clientQueue, save=save, replay=replay, snapshots=snapshots, 
+                                       showLeaders=showLeaders, expectedWindow=expectedWindow, raceId=raceId, 
+                                       ingestStats=ingestStats, connectionOptions=connectionOptions)
 
-        super(LiveThread, self).__init__(stopEvent=stopEvent, name='LiveThread')
+        super(LiveThread, self).__init__(stopEvent=stopEvent, name='LiveThread-%s' % (self.rd.raceId))
+        self.replayDone = Event()
 
         
     def work( self ):
         if self.replay:
+            if self.rd.fd is None:
+                # End of the recording, nothing more to do until we are stopped.
+                self.replayDone.set()
+                self.stopEvent.wait()
+                return
             self.rd.doReplay()
         else:
             self.rd.eventLoop(stopEvent=self.stopEvent, )
@@ -0,0 +1,169 @@
+import sys
+import threading
+from collections import Counter
+from functools import wraps
+from threading import Event, Lock
+from time import perf_counter
+
+from .threadex import ThreadEx
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Built-in profiling, for when racemgr falls behind at a venue.
+#
+# SamplingProfiler is a thread that every interval looks at the current
+# stack of each ThreadEx thread (sys._current_frames(), no tracing hooks, so
+# the other threads run at full speed) and counts the stacks.  The counts are
+# written in the folded format used by flamegraph.pl and speedscope:
+#
+#       LiveThread-r1;run;work;doReplay;onMessage;processRAM 42
+#
+# Sampling is started with --profile or at run time from the FlaskServer
+# /profile/ endpoints, which only answer local requests.
+#
+# The timers are exact: the time of every call of a few hot functions,
+# decorated with @timed.  They cost two perf_counter() calls per call while
+# enabled and one attribute test when not.
+#
+
+class Timers:
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = Lock()
+        self.stats = {}                 # name -> [calls, total, max]
+
+    def add(self, name, elapsed):
+        with self.lock:
+            stat = self.stats.get(name)
+            if stat is None:
+                stat = self.stats[name] = [0, 0.0, 0.0]
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def report(self):
+        with self.lock:
+            return {name: {'calls': calls, 'total_ms': total * 1000, 'mean_ms': total * 1000 / calls, 'max_ms': longest * 1000}
+                    for name, (calls, total, longest) in sorted(self.stats.items())}
+
+
+timers = Timers()
+
+
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not timers.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timers.add(name, perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def frameName(frame):
+    code = frame.f_code
+    return code.co_qualname if hasattr(code, 'co_qualname') else code.co_name
+
+
+class SamplingProfiler(ThreadEx):
+
+    def __init__(self, stopEvent=None, interval=0.01, maxDepth=64):
+        super(SamplingProfiler, self).__init__(stopEvent=stopEvent, name='SamplingProfiler')
+        self.daemon = True
+        self.interval = interval        # Seconds between samples.
+        self.maxDepth = maxDepth
+        self.running = Event()
+        self.wake = Event()             # Set by startSampling() and stop().
+        self.lock = Lock()
+        self.stacks = Counter()         # folded stack -> samples
+        self.samples = 0
+        self.started = None
+        self.elapsed = 0.0
+
+    def startSampling(self):
+        with self.lock:
+            if not self.running.is_set():
+                self.started = perf_counter()
+                self.running.set()
+                self.wake.set()
+        log('SamplingProfiler.startSampling: interval: %.3f' % (self.interval))
+
+    def stopSampling(self):
+        with self.lock:
+            if self.running.is_set():
+                self.running.clear()
+                self.elapsed += perf_counter() - self.started
+        log('SamplingProfiler.stopSampling: samples: %d' % (self.samples))
+
+    def reset(self):
+        with self.lock:
+            self.stacks = Counter()
+            self.samples = 0
+            self.elapsed = 0.0
+            if self.running.is_set():
+                self.started = perf_counter()
+
+    def sample(self):
+        # Only our own threads, not werkzeug request threads or the websocket_server handlers.
+        names = {t.ident: t.name for t in threading.enumerate() if isinstance(t, ThreadEx) and t is not self}
+        frames = sys._current_frames()
+        with self.lock:
+            for ident, name in names.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < self.maxDepth:
+                    stack.append(frameName(frame))
+                    frame = frame.f_back
+                stack.append(name)
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def work(self):
+        # Sleep until sampling is started, no polling while it is off.
+        self.wake.wait()
+        self.wake.clear()
+        while self.running.is_set() and not self.stopEvent.is_set():
+            self.sample()
+            self.stopEvent.wait(self.interval)
+
+    def folded(self):
+        with self.lock:
+            return ''.join('%s %d\n' % (stack, count) for stack, count in self.stacks.most_common())
+
+    def functions(self, top=30):
+        # Aggregate by function: self is the innermost frame, total is anywhere on the stack.
+        selfCounts, totalCounts = Counter(), Counter()
+        with self.lock:
+            for stack, count in self.stacks.items():
+                funcs = stack.split(';')[1:]
+                if funcs:
+                    selfCounts[funcs[-1]] += count
+                for func in set(funcs):
+                    totalCounts[func] += count
+        return [{'function': func, 'self': selfCounts[func], 'total': total} for func, total in totalCounts.most_common(top)]
+
+    def status(self):
+        with self.lock:
+            elapsed = self.elapsed + (perf_counter() - self.started if self.running.is_set() else 0)
+            return {'running': self.running.is_set(), 'samples': self.samples, 'seconds': elapsed, 'interval': self.interval}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            f.write(self.folded())
+        log('SamplingProfiler.save: %s samples: %d' % (filename, self.samples))
+
+    def stop(self):
+        self.stopSampling()
+        self.wake.set()
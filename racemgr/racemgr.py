@@ -1,24 +1,31 @@
+import os
 import sys
+import json
+import datetime
 from threading import Thread, Event
 from queue import Queue
 import traceback
 import argparse
+import tempfile
 import signal
 import platform
-from time import sleep
+from time import sleep, time
 
+# The servers, and the Flask, websocket_server and websocket-client imports
+# that come with them, are imported in raceMain() only when they are used.
 from .threadex import ThreadEx
-from .live import LiveThread
-from .wsserver import WSServer, Passings
-from .flaskserver import FlaskServer
+from .races import RaceRegistry, parseFeed
+from .profiler import SamplingProfiler, timers
+from . import clientqueue
 
-from .utils import log
+from .utils import log, HTTP_SERVERS
 
 
 __version__ = "0.2.0"
 
 
 StopEvent = Event()
+StartTime = time()
 
 
 def raceMain():
@@ -35,51 +42,126 @@ def raceMain():
     #    sleep(2)
 
     parser = argparse.ArgumentParser(description="Export start lists for a RaceDB competition.")
-    parser.add_argument('--crossmgr', type=str, default='localhost', help='CrossMgr host')
+    parser.add_argument('--crossmgr', type=str, nargs='+', default=['localhost'], help='CrossMgr host(s), as host or raceId=host')
     parser.add_argument('--port', type=int, default=11001, help='Flask port')
     parser.add_argument('--wsserver', type=int, default=11002, help='WSServer port')
+    parser.add_argument('--no-http', help='Do not start the Flask HTTP server', action='store_true')
+    parser.add_argument('--no-wsserver', help='Do not start the WebSocket server (or --workers)', action='store_true')
+    parser.add_argument('--http-server', type=str, default='threaded', choices=HTTP_SERVERS, help='Flask HTTP server model (threaded serves each request in its own thread)')
+    parser.add_argument('--leaders', type=int, default=10, help='Number of riders per category in the leaderboard')
+    parser.add_argument('--expected-window', type=int, default=60, help='Seconds ahead to show expected arrivals')
     parser.add_argument('--save', help='Save data to file', action='store_true')
-    parser.add_argument('--replay', type=str, default='', help='Replay data from')
+    parser.add_argument('--ingest-stats', help='Log the process memory, current and peak, with each CrossMgr message (uses tracemalloc, slows everything down)', action='store_true')
+    parser.add_argument('--replay', type=str, nargs='*', default=[], help='Replay data from file(s), as file or raceId=file')
+    parser.add_argument('--workers', type=int, default=0, help='Serve WebSocket clients from this many worker processes (0 serves them in this process)')
+    parser.add_argument('--ipc-socket', type=str, default='', help='Unix socket used to send frames to the workers')
+    parser.add_argument('--ping-interval', type=int, default=10, help='Seconds between pings to CrossMgr')
+    parser.add_argument('--max-backoff', type=int, default=30, help='Longest wait in seconds between CrossMgr connection attempts')
+    parser.add_argument('--profile', help='Sample the racemgr threads from startup and time the hot paths', action='store_true')
+    parser.add_argument('--profile-interval', type=float, default=10, help='Milliseconds between profile samples')
+    parser.add_argument('--profile-output', type=str, default='', help='Write the folded profile stacks here on exit')
+    parser.add_argument('--queue-size', type=int, default=10000, help='Most data messages waiting for dispatch before the oldest are dropped')
+    parser.add_argument('--keep-finished', type=int, default=4, help='Number of finished races kept for late viewers')
 
     args = parser.parse_args()
     print(args)
 
     StopEvent.clear()
-    ClientQueue = Queue()
-
+    if args.ingest_stats:
+        # Process wide, started once for all the feeds.
+        import tracemalloc
+        tracemalloc.start()
+    ClientQueue = clientqueue.ClientQueue(maxsize=args.queue_size)
+    races = RaceRegistry(keepFinished=args.keep_finished)
+
+    # One (raceId, crossmgr, replay) per feed, replays are named after their file unless given a raceId.
+    if args.replay:
+        feeds = [(raceId if raceId != replay else os.path.splitext(os.path.basename(replay))[0], 'localhost', replay)
+                 for raceId, replay in map(parseFeed, args.replay)]
+    else:
+        feeds = [(raceId, crossmgr, '') for raceId, crossmgr in map(parseFeed, args.crossmgr)]
+    log('feeds: %s' % (feeds,))
+
+    connectionOptions = dict(pingInterval=args.ping_interval, maxBackoff=args.max_backoff)
+
+    # Only import and build what was asked for, Flask alone is most of the startup time.
+    serveHTTP = not args.no_http
+    serveWS = not args.no_wsserver
     threads = []
-
-    passings = Passings(stopEvent=StopEvent, clientQueue=ClientQueue)
-    threads.append(passings)
-
-    threads.append(LiveThread(stopEvent=StopEvent, crossmgr=args.crossmgr, clientQueue=ClientQueue, 
-                              save=args.save, replay=args.replay, ))
-
-    wsserver = WSServer(stopEvent=StopEvent, port=args.wsserver, passings=passings, )
-    passings.wsserver = wsserver
-    threads.append(wsserver)
-
-    flaskserver = FlaskServer(stopEvent=StopEvent, webport=args.port, dataport=args.wsserver,  )
-    threads.append(flaskserver)
+    workers = []
+    passings = None
+    liveThreads = []
+    raceIds = [raceId for raceId, crossmgr, replay in feeds]
+
+    if serveWS and args.workers:
+        # This process only ingests, the workers serve the WebSocket clients.
+        from .fanout import FramePublisher, startWorkers
+        socketPath = args.ipc_socket or os.path.join(tempfile.gettempdir(), 'racemgr-%d.sock' % os.getpid())
+        threads.append(FramePublisher(stopEvent=StopEvent, clientQueue=ClientQueue, socketPath=socketPath))
+        workers = startWorkers(args.workers, socketPath, args.wsserver, raceIds, args.keep_finished)
+    elif serveWS:
+        from .wsserver import WSServer, Passings
+        passings = Passings(stopEvent=StopEvent, clientQueue=ClientQueue, raceIds=raceIds, keepFinished=args.keep_finished)
+        threads.append(passings)
+        wsserver = WSServer(stopEvent=StopEvent, port=args.wsserver, passings=passings, )
+        passings.wsserver = wsserver
+        threads.append(wsserver)
+    else:
+        ClientQueue = None              # Nobody to send to.
+
+    from .live import LiveThread
+    for raceId, crossmgr, replay in feeds:
+        liveThreads.append(LiveThread(stopEvent=StopEvent, crossmgr=crossmgr, clientQueue=ClientQueue, 
+                                  save=args.save, replay=replay, snapshots=races.add(raceId) if serveHTTP else None, showLeaders=args.leaders, 
+                                  expectedWindow=args.expected_window, raceId=raceId, 
+                                  ingestStats=args.ingest_stats, connectionOptions=connectionOptions, ))
+    threads += liveThreads
+    if passings is not None:
+        # Rider search works on the feeds' own indexes, with or without HTTP.
+        passings.searchIndexes = {t.rd.raceId: t.rd.riderIndex for t in liveThreads}
+
+    # With HTTP it is always there so it can be switched on from /profile/start, it idles until then.
+    profiler = None
+    if args.profile or serveHTTP:
+        profiler = SamplingProfiler(stopEvent=StopEvent, interval=args.profile_interval / 1000)
+        if args.profile:
+            timers.enabled = True
+            profiler.startSampling()
+        threads.append(profiler)
+
+    flaskserver = None
+    if serveHTTP:
+        from .flaskserver import FlaskServer
+        flaskserver = FlaskServer(stopEvent=StopEvent, webport=args.port, dataport=args.wsserver, 
+                                  httpServer=args.http_server, races=races, profiler=profiler, clientQueue=ClientQueue, )
+        threads.append(flaskserver)
 
     [v.start() for v in threads]
+    log('startup: %.3f seconds' % (time() - StartTime))
 
     try:
-        log("platform.system: %s" % (platform.system()))
-        if False and platform.system() == "Linux":
+        if not serveHTTP and not serveWS and all(replay for raceId, crossmgr, replay in feeds):
+            # Headless replay, done when the recordings are.
+            for t in liveThreads:
+                while not t.replayDone.wait(timeout=1) and not StopEvent.is_set():
+                    pass
+            StopEvent.set()
+        elif platform.system() != "Windows":
             log('StopEvent.wait')
             StopEvent.wait()
         else:
-            while not StopEvent.is_set():
-                log('Sleeping 2')
-                sleep(2)
+            # Windows does not deliver ^C to a thread blocked in a lock.
+            while not StopEvent.wait(timeout=1):
+                pass
 
     except KeyboardInterrupt:
         log("KeyboardInterrupt, stopping threads")
         pass
+    StopEvent.set()
     log("StopEvent received, stopping threads")
 
-    flaskserver.shutdown()
+    if flaskserver:
+        flaskserver.shutdown()
 
     for t in threads:
         log("Checking thread: %s" % t.name)
@@ -91,6 +173,14 @@ def raceMain():
             t.join()
             log("Joined thread: %s" % t.name)
 
+    if workers:
+        from .fanout import stopWorkers
+        stopWorkers(workers)
+
+    if profiler and profiler.samples:
+        profiler.save(args.profile_output or datetime.datetime.now().strftime('racemgr_%Y%m%d_%H%M%S.folded'))
+        log('timers: %s' % (json.dumps(timers.report(), indent=1)))
+
 if __name__ == '__main__':
     raceMain()
 
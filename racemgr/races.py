@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from threading import Lock
+
+from .snapshot import SnapshotStore
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Several CrossMgr feeds in one racemgr.
+#
+# Each feed has a raceId, taken from the command line as "raceId=host" (or
+# just "host", in which case the host is the raceId).  The registry holds a
+# SnapshotStore per feed for the HTTP side.
+#
+# When a feed moves on to a new race (the raceName changes) the last snapshot
+# of the old race is kept under "raceId/raceName" so late viewers can still
+# see the results.  Only the most recent keepFinished races are kept.
+#
+
+def parseFeed(feed):
+    """Split "raceId=host" (or "host") into (raceId, host)."""
+    raceId, sep, host = feed.partition('=')
+    if not sep:
+        host = raceId
+    return raceId, host
+
+
+def archiveId(raceId, raceName):
+    return '%s/%s' % (raceId, raceName)
+
+
+class RaceRegistry:
+
+    def __init__(self, keepFinished=4):
+        self.keepFinished = keepFinished
+        self.lock = Lock()
+        self.live = OrderedDict()       # raceId -> SnapshotStore, in command line order
+        self.finished = OrderedDict()   # archiveId -> SnapshotStore, oldest first
+
+    def add(self, raceId):
+        store = SnapshotStore(raceId=raceId, registry=self)
+        self.live[raceId] = store
+        return store
+
+    @property
+    def defaultId(self):
+        return next(iter(self.live), None)
+
+    def get(self, raceId=None):
+        if raceId is None:
+            raceId = self.defaultId
+        with self.lock:
+            return self.live.get(raceId) or self.finished.get(raceId)
+
+    def archive(self, raceId, snapshot):
+        # Called by a live store when its feed starts a new race.
+        raceName = snapshot.raceInfo.get('raceName', '')
+        if not raceName:
+            return
+        store = SnapshotStore(raceId=archiveId(raceId, raceName))
+        store.publish(snapshot)
+        with self.lock:
+            self.finished.pop(store.raceId, None)
+            self.finished[store.raceId] = store
+            while len(self.finished) > self.keepFinished:
+                oldId, old = self.finished.popitem(last=False)
+                log('RaceRegistry.archive: dropping: %s' % (oldId))
+        log('RaceRegistry.archive: %s' % (store.raceId))
+
+    def status(self):
+        # Counters are only updated by their feed thread, a copy is close enough.
+        with self.lock:
+            return {raceId: dict(store.stats or {}) for raceId, store in self.live.items()}
+
+    def races(self):
+        def summary(raceId, store, live):
+            snapshot = store.current()
+            return {
+                'raceId': raceId,
+                'live': live,
+                'raceName': snapshot.raceInfo.get('raceName', '') if snapshot else '',
+                'versionCount': snapshot.raceInfo.get('versionCount', -1) if snapshot else -1,
+            }
+        with self.lock:
+            return ([summary(raceId, store, True) for raceId, store in self.live.items()] +
+                    [summary(raceId, store, False) for raceId, store in reversed(self.finished.items())])
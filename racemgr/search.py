@@ -0,0 +1,144 @@
+from bisect import bisect_left, insort
+from itertools import chain
+from threading import Lock
+
+
+#-----------------------------------------------------------------------
+#
+# Rider lookup.
+#
+# Riders are indexed by bib, and by last name, first name and team prefix in
+# sorted lists of (lower case key, bib) that are searched with bisect.  The
+# indexes are updated from the riders in each infoRAM, and only when the
+# name, team or category of a rider has changed.
+#
+# A query is split into words, each word must be the start of the bib, last
+# name, first name or team of a rider.  Only the index ranges of the word with
+# the fewest entries are walked, and only until limit riders are found.  The
+# matches come back with the rider's recorded rows, which SynchronizedRaceData
+# keeps grouped by bib.
+#
+
+def prefixRange(index, prefix):
+    """The (key, bib) entries of the sorted index whose key starts with prefix."""
+    i = bisect_left(index, (prefix, ''))
+    while i < len(index) and index[i][0].startswith(prefix):
+        yield index[i]
+        i += 1
+
+
+class RiderIndex:
+
+    fields = ('LastName', 'FirstName', 'Team', )
+
+    def __init__(self, limit=20):
+        self.limit = limit              # Most riders returned by a query.
+        self.lock = Lock()
+        self.riderRows = {}             # bib -> recorded rows, replaced as a whole by printRecent
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.riders = {}            # bib -> (LastName, FirstName, Team, raceCat)
+            self.bibs = []              # sorted (bib, bib), for bib prefixes
+            self.names = {field: [] for field in self.fields}   # field -> sorted (key, bib)
+            self.categories = {}        # raceCat -> set of bibs
+
+    def load(self, info):
+        # Baseline, build the sorted lists in one go rather than one insort per rider.
+        self.reset()
+        with self.lock:
+            for bib, data in info.items():
+                self.riders[str(bib)] = self.entry(data)
+            self.bibs = sorted((bib, bib) for bib in self.riders)
+            for i, field in enumerate(self.fields):
+                self.names[field] = sorted((entry[i].lower(), bib) for bib, entry in self.riders.items() if entry[i])
+            for bib, entry in self.riders.items():
+                self.categories.setdefault(entry[3], set()).add(bib)
+
+    def entry(self, data):
+        return tuple(str(data.get(field) or '') for field in self.fields) + (data.get('raceCat', ''), )
+
+    def updateRider(self, bib, data):
+        bib = str(bib)
+        entry = self.entry(data)
+        with self.lock:
+            old = self.riders.get(bib)
+            if old == entry:
+                return
+            if old is not None:
+                self.unindex(bib, old)
+            else:
+                insort(self.bibs, (bib, bib))
+            self.riders[bib] = entry
+            for i, field in enumerate(self.fields):
+                if entry[i]:
+                    insort(self.names[field], (entry[i].lower(), bib))
+            self.categories.setdefault(entry[3], set()).add(bib)
+
+    def unindex(self, bib, entry):
+        for i, field in enumerate(self.fields):
+            if entry[i]:
+                index = self.names[field]
+                j = bisect_left(index, (entry[i].lower(), bib))
+                if j < len(index) and index[j] == (entry[i].lower(), bib):
+                    del index[j]
+        self.categories.get(entry[3], set()).discard(bib)
+
+    def removeRider(self, bib):
+        bib = str(bib)
+        with self.lock:
+            old = self.riders.pop(bib, None)
+            if old is None:
+                return
+            self.unindex(bib, old)
+            j = bisect_left(self.bibs, (bib, bib))
+            if j < len(self.bibs) and self.bibs[j] == (bib, bib):
+                del self.bibs[j]
+
+    def indexes(self, word):
+        return ([self.bibs] if word.isdigit() else []) + list(self.names.values())
+
+    def rangeSize(self, word):
+        return sum(bisect_left(index, (word + '\uffff', '')) - bisect_left(index, (word, '')) for index in self.indexes(word))
+
+    def matches(self, bib, word, category):
+        entry = self.riders[bib]
+        if category and entry[3] != category:
+            return False
+        return bib.startswith(word) or any(entry[i].lower().startswith(word) for i in range(len(self.fields)))
+
+    def search(self, query, category=None, limit=None):
+        limit = limit or self.limit
+        words = query.lower().split()
+        with self.lock:
+            if words:
+                # Walk the index ranges of the most selective word, check the others against the rider.
+                # Broad prefixes stop as soon as there are enough riders.
+                words.sort(key=self.rangeSize)
+                first, rest = words[0], words[1:]
+                candidates = [first] if first in self.riders else []
+                for index in self.indexes(first):
+                    candidates = chain(candidates, (bib for key, bib in prefixRange(index, first)))
+            elif category:
+                first, rest = '', []
+                candidates = sorted(self.categories.get(category, ()), key=lambda bib: (len(bib), bib))
+            else:
+                return []
+            found, seen = [], set()
+            for bib in candidates:
+                if bib in seen:
+                    continue
+                seen.add(bib)
+                if self.matches(bib, first, category) and all(self.matches(bib, word, category) for word in rest):
+                    found.append((bib, self.riders[bib]))
+                    if len(found) >= limit:
+                        break
+        riderRows = self.riderRows
+        return [{
+            'bib': int(bib) if bib.isdigit() else bib,
+            'name': '%s,%s' % (entry[0], entry[1]),
+            'team': entry[2],
+            'category': entry[3],
+            'rows': riderRows.get(bib, []),
+        } for bib, entry in found]
@@ -0,0 +1,140 @@
+import io
+import csv
+import json
+import hashlib
+from threading import Lock
+
+from .utils import log
+
+
+#-----------------------------------------------------------------------
+#
+# Snapshots of the race data for the HTTP API.
+#
+# The ingest thread (SynchronizedRaceData) builds a RaceSnapshot after every
+# change and publishes it here.  A snapshot is never modified after it is
+# published, so the HTTP threads can read it without holding any locks.
+#
+# Encoded responses are cached per (view, format) and keyed to the race
+# versionCount, so polling clients cost one dictionary lookup (or a 304)
+# until CrossMgr sends a new version.
+#
+
+# Rows per chunk when streaming a large table.
+CHUNK_ROWS = 200
+
+LEADER_HEADERS = ('Category', 'Rank', 'Bib', 'FirstName', 'LastName', 'Team', 'Gap', )
+
+MIMETYPES = {'json': 'application/json', 'csv': 'text/csv'}
+
+
+class RaceSnapshot:
+    def __init__(self, raceInfo, headers, rows, leaders):
+        self.raceInfo = raceInfo        # Dict of race state, includes raceName and versionCount.
+        self.headers = headers          # Recorded table headers.
+        self.rows = rows                # Recorded table rows, in rowIndex order.
+        self.leaders = leaders          # List of {'category': name, 'riders': [...]} in CrossMgr order.
+
+    @property
+    def key(self):
+        return (self.raceInfo.get('raceName', ''), self.raceInfo.get('versionCount', -1))
+
+
+def csvChunks(headers, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(headers)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % CHUNK_ROWS == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def jsonChunks(prefix, items):
+    yield prefix[:-1] + ', "rows": ['
+    for i in range(0, len(items), CHUNK_ROWS):
+        yield (', ' if i else '') + ', '.join(json.dumps(item) for item in items[i:i+CHUNK_ROWS])
+    yield ']}'
+
+
+def leaderRows(snapshot):
+    for cat in snapshot.leaders:
+        for r in cat['riders']:
+            yield (cat['category'], r['rank'], r['bib'], r['FirstName'], r['LastName'], r['Team'], r['gap'], )
+
+
+def encodePassings(snapshot, fmt):
+    if fmt == 'csv':
+        return csvChunks(snapshot.headers, snapshot.rows)
+    return jsonChunks(json.dumps({'race': snapshot.raceInfo, 'headers': snapshot.headers}), snapshot.rows)
+
+
+def encodeLeaders(snapshot, fmt):
+    if fmt == 'csv':
+        return csvChunks(LEADER_HEADERS, list(leaderRows(snapshot)))
+    return iter([json.dumps({'race': snapshot.raceInfo, 'leaders': snapshot.leaders})])
+
+
+def encodeRace(snapshot, fmt):
+    if fmt == 'csv':
+        info = snapshot.raceInfo
+        return csvChunks(list(info.keys()), [list(info.values())])
+    return iter([json.dumps(snapshot.raceInfo)])
+
+
+ENCODERS = {
+    'passings': encodePassings,
+    'leaders': encodeLeaders,
+    'race': encodeRace,
+}
+
+
+class SnapshotStore:
+
+    def __init__(self, raceId=None, registry=None):
+        self.raceId = raceId
+        self.registry = registry        # RaceRegistry, keeps the last snapshot of finished races.
+        self.lock = Lock()
+        self.snapshot = None
+        self.cache = {}
+        self.stats = None               # Connection counters of the live feed, see CrossMgrConnection.
+        self.analytics = None           # RaceAnalytics of the live feed.
+        self.search = None              # RiderIndex of the live feed.
+
+    def publish(self, snapshot):
+        previous = self.snapshot
+        with self.lock:
+            if self.snapshot is None or self.snapshot.key != snapshot.key:
+                self.cache = {}
+            self.snapshot = snapshot
+        if self.registry and previous is not None and previous.key[0] != snapshot.key[0]:
+            self.registry.archive(self.raceId, previous)
+        log('SnapshotStore.publish[%s]: %s rows: %d' % (self.raceId, snapshot.key, len(snapshot.rows)))
+
+    def current(self):
+        return self.snapshot
+
+    def etag(self, snapshot, name, fmt):
+        raceName, versionCount = snapshot.key
+        return hashlib.sha1(('%s\0%s\0%s\0%s' % (raceName, versionCount, name, fmt)).encode('utf-8')).hexdigest()
+
+    def cached(self, snapshot, name, fmt):
+        return self.cache.get((snapshot.key, name, fmt))
+
+    def encode(self, snapshot, name, fmt, bodyFactory):
+        """Yield the encoded chunks, then cache the complete body for the next request.
+
+        bodyFactory(body, mimetype, etag) wraps the body for the HTTP layer.
+        """
+        chunks = []
+        for chunk in ENCODERS[name](snapshot, fmt):
+            chunks.append(chunk)
+            yield chunk
+        entry = bodyFactory(''.join(chunks), MIMETYPES[fmt], self.etag(snapshot, name, fmt))
+        with self.lock:
+            # Only keep it if the store has not moved on to a newer version.
+            if self.snapshot is not None and self.snapshot.key == snapshot.key:
+                self.cache[(snapshot.key, name, fmt)] = entry
@@ -5,5 +5,28 @@ import sys
 import datetime
 getTimeNow = datetime.datetime.now                                                       
 
+# Flask HTTP server models, see FlaskServer.
+HTTP_SERVERS = ['single', 'threaded']
+
 def log(s):
     print('%s %s' % (getTimeNow().strftime('%H:%M:%S'), s.rstrip()), file=sys.stderr)
+
+def find_last_false(arr):
+    try:
+        # Reverse the list and find the first False, then calculate the original index
+        return len(arr) - 1 - arr[::-1].index(False)
+    except ValueError:
+        # If there's no False value, return -1
+        return -1
+
+def find_last_true(arr):
+    try:
+        return len(arr) - 1 - arr[::-1].index(True)
+    except ValueError:
+        return -1
+
+def hhmmss( raceTime ):
+    seconds = round(raceTime)
+    minutes = seconds // 60
+    hours = seconds // 3600
+    return '%02d:%02d' % (minutes, seconds % 60)
@@ -1,83 +1,236 @@
 import sys
+import json
+import socket
 import traceback
+from collections import OrderedDict
 
 from websocket_server import WebsocketServer
-from threading import Thread, Event
+from threading import Thread, Event, RLock
 from queue import Empty
-from time import sleep
+from time import sleep, time
 
 from .threadex import ThreadEx
 from .utils import log
+from .profiler import timed
+
+class RaceChannel:
+    # Current state of one race, everything a new client needs to catch up.
+
+    def __init__(self, raceId):
+        self.raceId = raceId
+        self.raceName = ''
+        self.passings = []
+        self.clients = []
+        self.race_info = None
+        self.leaders = {}               # Latest leaders message per category.
+        self.expected = None            # Latest expected arrivals, only sent to subscribed clients.
+        self.clock = None               # Latest race clock anchor.
+
+    def reset(self):
+        self.passings = []
+        self.race_info = None
+        self.leaders = {}
+        self.expected = None
+        self.clock = None
+
+    def clockNow(self):
+        # The anchor moved forward to now, so a client that connects later starts at the right time.
+        anchor = json.loads(self.clock)
+        now = time()
+        if anchor['running']:
+            anchor['raceTime'] += now - anchor['wallTime']
+        anchor['wallTime'] = now
+        return json.dumps(anchor)
+
+    def archive(self, raceId):
+        # Frozen copy of the current state for late viewers.
+        channel = RaceChannel(raceId)
+        channel.raceName = self.raceName
+        channel.passings = list(self.passings)
+        channel.race_info = self.race_info
+        channel.leaders = dict(self.leaders)
+        return channel
+
 
 class Passings(ThreadEx):
 
-    def __init__(self, stopEvent=None, clientQueue=None):
-        log("Passings.__init__")
+    def __init__(self, stopEvent=None, clientQueue=None, raceIds=None, keepFinished=4):
+        log("Passings.__init__ raceIds: %s" % (raceIds,))
         super(Passings, self).__init__(stopEvent=stopEvent, name="Passings")
         self.stopEvent = stopEvent
         self.clientQueue = clientQueue
 
         self.wsserver = None
-        self.passings = []
-        self.clients = []
-        self.race_info = None
+        self.keepFinished = keepFinished
+        # Live races in command line order, the first is the default for new clients.
+        self.channels = OrderedDict((raceId, RaceChannel(raceId)) for raceId in (raceIds or ['localhost']))
+        self.finished = OrderedDict()   # Recently finished races, oldest first.
+        self.clientChannel = {}         # client id -> RaceChannel
+        self.searchIndexes = {}         # raceId -> RiderIndex of the live feed, only in the ingest process
+        # Clients join and leave on the websocket_server handler threads while
+        # dispatch() sends on this one.  The lock keeps a client's catch-up
+        # state and the live messages in order, and the client lists steady.
+        self.lock = RLock()
+
+    @property
+    def defaultChannel(self):
+        return next(iter(self.channels.values()))
+
+    def channel(self, raceId):
+        return self.channels.get(raceId) or self.finished.get(raceId)
 
     # Send a client a message
     def sendClient(self, client, data):
         log("wsserver.sendClient client: %s data: %s" % (client, data))
         self.wsserver.send_message(client, str(data))
 
-    # Add a new client to the list, send all current data
+    # Send all current data for a race
+    def sendState(self, client, channel):
+        log("Passings.sendState client: %s race: %s" % (client['id'], channel.raceId))
+        log("Passings.sendState race_info: %s" % channel.race_info)
+        log("Passings.sendState passings: %s" % len(channel.passings))
+        if channel.race_info:
+            self.sendClient(client, channel.race_info)
+        for r in channel.passings:
+            self.sendClient(client, r)
+        for r in channel.leaders.values():
+            self.sendClient(client, r)
+        if channel.clock:
+            self.sendClient(client, channel.clockNow())
+        if channel.expected and client in self.wsserver.dataClients['expected']:
+            self.sendClient(client, channel.expected)
+
+    # Add a new client to the default race, send all current data
     def new_client(self, client):
-        self.clients.append(client)
         log("Passings.new_client client: %ss" % client)
-        log("Passings.new_client race_info: %s" % self.race_info)
-        log("Passings.new_client passings: %s" % len(self.passings))
-        if self.race_info:
-            self.sendClient(client, self.race_info)
-        for r in self.passings:
-            self.sendClient(client, r)
+        with self.lock:
+            self.joinChannel(client, self.defaultChannel)
+
+    def joinChannel(self, client, channel):
+        old = self.clientChannel.get(client['id'])
+        if old and client in old.clients:
+            old.clients.remove(client)
+        self.clientChannel[client['id']] = channel
+        channel.clients.append(client)
+        self.sendState(client, channel)
+
+    # A client picked a race, {"cmd": "race", "race": raceId}
+    def selectRace(self, client, raceId):
+        with self.lock:
+            channel = self.channel(raceId)
+            if channel is None:
+                log("Passings.selectRace: unknown race: %s" % raceId)
+                return
+            if self.clientChannel.get(client['id']) is not channel:
+                self.joinChannel(client, channel)
+
+    # A client subscribed to an optional data type, send the current state
+    def subscribed(self, client, dataType):
+        log("Passings.subscribed client: %s dataType: %s" % (client['id'], dataType))
+        with self.lock:
+            channel = self.clientChannel.get(client['id'])
+            if dataType == 'expected' and channel and channel.expected:
+                self.sendClient(client, channel.expected)
+
+    # Rider lookup in the client's race, {"cmd": "search", "q": "smi", "category": "", "id": 1}
+    def search(self, client, request):
+        channel = self.clientChannel.get(client['id'], self.defaultChannel)
+        index = self.searchIndexes.get(channel.raceId)
+        results = index.search(str(request.get('q', '')), category=request.get('category')) if index else []
+        self.sendClient(client, json.dumps({
+            'type': 'search', 'id': request.get('id'), 'q': request.get('q', ''),
+            'available': index is not None, 'results': results,
+        }))
 
     def client_left(self, client, ):
         print("Client(%d) disconnected" % client['id'])
-        if client in self.clients:
-            self.clients.remove(client)
+        with self.lock:
+            channel = self.clientChannel.pop(client['id'], None)
+            if channel and client in channel.clients:
+                channel.clients.remove(client)
+
+    def archive(self, channel):
+        # Keep the race that just finished around for late viewers.
+        if not channel.raceName or not channel.passings:
+            return
+        finished = channel.archive('%s/%s' % (channel.raceId, channel.raceName))
+        self.finished.pop(finished.raceId, None)
+        self.finished[finished.raceId] = finished
+        while len(self.finished) > self.keepFinished:
+            raceId, old = self.finished.popitem(last=False)
+            # joinChannel() takes the client off old.clients.
+            for client in list(old.clients):
+                self.joinChannel(client, self.channels.get(raceId.split('/')[0], self.defaultChannel))
+        log("Passings.archive: %s" % finished.raceId)
 
     # reset
     def reset(self):
-        self.passings = []
+        for channel in self.channels.values():
+            channel.reset()
 
     # Called from run() to process the message queue
     def work(self):
         #log("Passings.work")
         try:
-            message = self.clientQueue.get(block=False, timeout=0)
-            log("Passings.work message: %s" % (str(message)))
-            dataType, data = message
-            if dataType == 'baseline':
-                self.passings = []
-                self.race_info = None
-            elif dataType in ['race_info', ]:
-                self.race_info = data
-                log('race_info: %s' % data)
-                for client in self.clients:
-                    self.sendClient(client, data)
-            elif dataType in ['race_time', ]:
-                for client in self.clients:
-                    self.sendClient(client, data)
-            elif dataType in ['recorded', ]:
-                self.passings.append(data)
-                for client in self.clients:
-                    self.sendClient(client, data)
+            message = self.clientQueue.get(timeout=2)
         except Empty:
             log("Passings.work Empty")
-            sleep(2)
             return
+        self.dispatch(message)
+
+    # Timed apart from work() so the time spent waiting on the queue is not counted.
+    @timed('Passings.work')
+    def dispatch(self, message):
+        log("Passings.work message: %s" % (str(message)))
+        with self.lock:
+            self.deliver(message)
+
+    def deliver(self, message):
+        raceId, dataType, data = message
+        channel = self.channels.get(raceId)
+        if channel is None:
+            channel = self.channels[raceId] = RaceChannel(raceId)
+        if dataType == 'baseline':
+            # The baseline carries the race name, a new name means the old race is over.
+            if data != channel.raceName:
+                self.archive(channel)
+                channel.raceName = data
+            channel.reset()
+        elif dataType in ['race_info', ]:
+            channel.race_info = data
+            log('race_info: %s' % data)
+            for client in channel.clients:
+                self.sendClient(client, data)
+        elif dataType in ['race_time', ]:
+            channel.clock = data
+            for client in channel.clients:
+                self.sendClient(client, data)
+        elif dataType in ['recorded', ]:
+            channel.passings.append(data)
+            for client in channel.clients:
+                self.sendClient(client, data)
+        elif dataType in ['leaders', ]:
+            # Only the latest board per category is needed by new clients.
+            channel.leaders[json.loads(data)['category']] = data
+            for client in channel.clients:
+                self.sendClient(client, data)
+        elif dataType in ['expected', ]:
+            channel.expected = data
+            for client in self.wsserver.dataClients[dataType]:
+                if client in channel.clients:
+                    self.sendClient(client, data)
+
+class ReusePortWebsocketServer(WebsocketServer):
+    # Several worker processes listen on the same port, the kernel balances the connections.
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super(ReusePortWebsocketServer, self).server_bind()
+
 
 class WSServer(ThreadEx):
 
-    dataTypes = ['test', 'recorded', 'expected', 'passing',]
-    def __init__(self, stopEvent=None, host='0.0.0.0', port=11002, passings=None):
+    dataTypes = ['test', 'recorded', 'expected', 'passing', 'leaders',]
+    def __init__(self, stopEvent=None, host='0.0.0.0', port=11002, passings=None, reusePort=False):
         log("WSServer.__init__ host: %s port: %d" % (host, port))
         super(WSServer, self).__init__(stopEvent=stopEvent, name="WSServer")
         self.host = host
@@ -87,7 +240,7 @@ class WSServer(ThreadEx):
         self.clients = {}
         self.dataClients = {k:[] for k in self.dataTypes}
 
-        self.server = WebsocketServer(host=host, port=port)
+        self.server = (ReusePortWebsocketServer if reusePort else WebsocketServer)(host=host, port=port)
         self.server.set_fn_new_client(self.new_client)
         self.server.set_fn_client_left(self.client_left)
         self.server.set_fn_message_received(self.message_received)
@@ -111,11 +264,43 @@ class WSServer(ThreadEx):
         self.passings.client_left(client)
         if client['id'] in self.clients:
             del self.clients[client['id']]
+        with self.passings.lock:
+            for clients in self.dataClients.values():
+                if client in clients:
+                    clients.remove(client)
 
     
     # Called when a client sends a message
+    # Clients pick a race with {"cmd": "race", "race": raceId}, opt in to optional
+    # data types with {"cmd": "subscribe", "types": ["expected"]} and out again
+    # with {"cmd": "unsubscribe", "types": [...]}, and look up riders with
+    # {"cmd": "search", "q": ...}.
     def message_received(self, client, server, message):
         log("WSServer.message_received client[%s] %s" % (client['id'], message))
+        try:
+            request = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(request, dict):
+            return
+        cmd = request.get('cmd')
+        if cmd == 'race':
+            self.passings.selectRace(client, request.get('race'))
+            return
+        if cmd == 'search':
+            self.passings.search(client, request)
+            return
+        with self.passings.lock:
+            for dataType in request.get('types', []):
+                if dataType not in self.dataTypes:
+                    log("WSServer.message_received: Invalid data type: %s" % dataType)
+                    continue
+                clients = self.dataClients[dataType]
+                if cmd == 'subscribe' and client not in clients:
+                    clients.append(client)
+                    self.passings.subscribed(client, dataType)
+                elif cmd == 'unsubscribe' and client in clients:
+                    clients.remove(client)
         #if len(message) > 200:
         #    message = message[:200]+'..'
         #print("Client(%d) said: %s" % (client['id'], message), file=sys.stderr)
@@ -129,7 +314,7 @@ class WSServer(ThreadEx):
     def send(self, dataType, data):
         log("WSServer.send dataType: %s data: %s" % (dataType, data))
         if dataType not in self.dataTypes:
-            log("WSSever.send: Invalid data type: %s" % dataType, file=sys.stderr)
+            log("WSSever.send: Invalid data type: %s" % dataType)
             return
         log("WSServer.send dataClients: %s" % ([(k, len(self.dataClients[k])) for k in self.dataClients.keys()]))
         for client in self.dataClients[dataType]:
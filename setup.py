@@ -22,9 +22,10 @@ setup(
     name = "startlist",
     packages = ["racemgr",],
     #install_requires = [ "psycopg2", "yattag", "openpyxl", ],
-    install_requires = [ "flask", "websocket_server", "websocket-client", ]
+    install_requires = [ "flask", "websocket_server", "websocket-client", ],
+    extras_require = { "brotli": [ "brotli", ], },
     entry_points = {
-        "console_scripts": ['racemgr = racemgr.racemgr:raceMain'],
+        "console_scripts": ['racemgr = racemgr.racemgr:raceMain', 'racemgr-batch = racemgr.batch:batchMain'],
         },
     package_data = { },
     version = version,